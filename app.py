@@ -6,7 +6,7 @@ import seaborn as sns
 import asyncio
 import traceback
 import os
-from src.preprocessing import load_data, preprocess
+from src.preprocessing import load_data, preprocess, apply_transaction_schema
 from src.advanced_models import advanced_model_pipeline, get_model_contributions, visualize_model_comparison
 from src.rules import rule_engine, get_rule_explanations
 from src.explainability import calculate_shap_values, plot_feature_importance, generate_explanation_text, aggregate_explanations
@@ -18,6 +18,12 @@ from src.enhanced_visualizations import enhanced_viz
 from src.user_preferences import user_prefs
 from src.localization import localization_manager
 from src.data_processor import data_processor
+from src.chunked_scoring import score_all_rows
+from src.parallel_analysis import analyze_files_parallel, score_frame
+from src.feature_store import FeatureStore, feature_matrix_store
+from src.quantile_sketch import QuantileSketch, quantile_sketch_store
+from src.model_registry import model_registry, MIN_REFERENCE_TRAINING_ROWS
+from src.resource_governor import resource_governor
 from src.progress_manager import progress_manager
 from src.user_database import user_db
 from src.advanced_models import build_transaction_graph, predict_fraud_probability_next_week, cluster_user_profiles
@@ -864,6 +870,21 @@ contamination_level = st.sidebar.slider(
     help="Процент транзакций, которые вы ожидаете увидеть как мошеннические"
 )
 st.sidebar.markdown(f'<p style="color: white; text-align: center; font-weight: 600; background: rgba(102, 126, 234, 0.3); padding: 10px; border-radius: 10px;">{contamination_level*100:.1f}%</p>', unsafe_allow_html=True)
+full_scoring_mode = st.sidebar.checkbox(
+    "🧮 Оценить все строки (потоковый режим)",
+    value=False,
+    help="Модели обучаются на репрезентативной выборке, затем каждая транзакция оценивается пакетами с записью результатов на диск"
+)
+retrain_models = st.sidebar.checkbox(
+    "🔁 Переобучить модели",
+    value=False,
+    help="По умолчанию повторно используются модели, уже обученные на этих же данных, а для других файлов — эталонные модели с той же схемой признаков; отметьте, чтобы обучить их заново на текущих данных"
+)
+promote_models = st.sidebar.checkbox(
+    "📌 Сделать модели эталонными",
+    value=False,
+    help=f"Модели текущего анализа, обученные минимум на {MIN_REFERENCE_TRAINING_ROWS} строках, будут использоваться для других файлов с той же схемой признаков без переобучения"
+)
 st.sidebar.markdown('</div>', unsafe_allow_html=True)
 
 
@@ -1067,6 +1088,21 @@ if st.session_state.get('test_file_path'):
     st.session_state['analysis_type'] = 'separate'
     st.info(f"✅ Тестовый файл загружен: {st.session_state['test_file_path']}")
 
+def store_analysis_result(file_name, df, analysis):
+    if 'analysis_results' not in st.session_state:
+        st.session_state['analysis_results'] = {}
+    
+    suspicious_count = int(np.sum(analysis['is_suspicious']))
+    st.session_state['analysis_results'][file_name] = {
+        'total_transactions': len(df),
+        'suspicious_count': suspicious_count,
+        'clean_count': int(len(df) - suspicious_count),
+        'fraud_percentage': (suspicious_count / len(df)) * 100,
+        'combined_scores': analysis['combined_scores'],
+        'model_contributions': analysis['model_details'] if analysis['model_details'] else {},
+        'is_suspicious': analysis['is_suspicious']
+    }
+
 if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_files_list'):
     files_to_process = st.session_state['uploaded_files_list']
     analysis_mode = st.session_state.get('analysis_type', 'separate')
@@ -1074,43 +1110,88 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
     if analysis_mode == 'combined':
         st.markdown('<h2>🔄 Объединенный анализ всех файлов</h2>', unsafe_allow_html=True)
         all_dfs = []
+        file_hashes = []
         for file in files_to_process:
             try:
                 if isinstance(file, str):
-                    df_temp = load_data(file)
+                    df_temp = data_processor.load_raw(file)
                 else:
-                    temp_path = f"temp_{file.name}"
-                    with open(temp_path, "wb") as f:
-                        f.write(file.getbuffer())
-                    df_temp = load_data(temp_path)
-                    os.remove(temp_path)
+                    df_temp = data_processor.load_raw(file, file_name=file.name)
+                file_hash = data_processor.get_file_hash(file)
+                # per-file amount sketches are kept so the combined threshold is a merge, not a re-sketch
+                stored_sketches = quantile_sketch_store.load(file_hash)
+                if 'amount' not in stored_sketches:
+                    stored_sketches['amount'] = QuantileSketch.from_values(pd.to_numeric(df_temp['amount'], errors='coerce'))
+                    quantile_sketch_store.save(file_hash, stored_sketches)
                 all_dfs.append(df_temp)
+                file_hashes.append(file_hash)
             except Exception as e:
                 st.error(f"❌ Ошибка загрузки файла: {str(e)}")
                 continue
         if all_dfs:
-            df = pd.concat(all_dfs, ignore_index=True)
+            df = apply_transaction_schema(pd.concat(all_dfs, ignore_index=True))
             st.success(f"✅ Объединено {len(all_dfs)} файлов. Всего транзакций: {len(df)}")
-            files_to_analyze = [{'name': 'Объединенные данные', 'data': df}]
+            files_to_analyze = [{'name': 'Объединенные данные', 'data': df,
+                                 'file_hash': data_processor.combine_hashes(file_hashes), 'file_hashes': file_hashes}]
     else:
         st.markdown('<h2>🔄 Отдельный анализ каждого файла</h2>', unsafe_allow_html=True)
         files_to_analyze = []
+        sources = []
         for file in files_to_process:
+            if isinstance(file, str):
+                sources.append((file.split('/')[-1], file))
+            else:
+                sources.append((file.name, file.getvalue()))
+        
+        selected_models = st.session_state['confirmed_models'] if st.session_state.get('confirmed_models') else model_options
+        
+        in_memory_sources = []
+        for file_name, source in sources:
+            required_mb = resource_governor.estimate_frame_mb(data_processor.get_source_size(source))
+            if resource_governor.can_fit(required_mb):
+                in_memory_sources.append((file_name, source))
+                continue
+            
+            st.warning(f"⚠️ {file_name}: для анализа в памяти нужно ~{required_mb:,.0f} МБ, доступно "
+                       f"{resource_governor.headroom_mb():,.0f} МБ. Файл оценивается в потоковом режиме.")
             try:
-                if isinstance(file, str):
-                    df_temp = load_data(file)
-                    file_name = file.split('/')[-1]
-                else:
-                    temp_path = f"temp_{file.name}"
-                    with open(temp_path, "wb") as f:
-                        f.write(file.getbuffer())
-                    df_temp = load_data(temp_path)
-                    os.remove(temp_path)
-                    file_name = file.name
-                files_to_analyze.append({'name': file_name, 'data': df_temp})
+                with st.spinner(f"🧮 Потоковая оценка {file_name}..."):
+                    safe_name = os.path.splitext(os.path.basename(file_name))[0]
+                    scoring_summary = score_all_rows(
+                        source,
+                        os.path.join("scored_output", f"scored_{safe_name}.csv"),
+                        model_types=selected_models,
+                        contamination=contamination_level,
+                        file_name=file_name
+                    )
+                st.success(f"✅ {file_name}: оценено {scoring_summary['rows_scored']:,} транзакций за "
+                           f"{scoring_summary['execution_time']:.1f} сек. Подозрительных: {scoring_summary['suspicious_count']:,}")
+                with open(scoring_summary['output_path'], 'rb') as scored_file:
+                    st.download_button(
+                        label=f"📥 Скачать оценку {file_name} (CSV)",
+                        data=scored_file,
+                        file_name=os.path.basename(scoring_summary['output_path']),
+                        mime="text/csv",
+                        key=f"streamed_scoring_download_{safe_name}"
+                    )
             except Exception as e:
-                st.error(f"❌ Ошибка загрузки {file}: {str(e)}")
-                continue
+                st.error(f"❌ Ошибка потоковой оценки {file_name}: {str(e)}")
+        sources = in_memory_sources
+        
+        with st.spinner(f"🧠 Параллельный анализ файлов: {len(sources)}..."):
+            for position, file_name, analysis, error in analyze_files_parallel(sources, selected_models, contamination_level,
+                                                                                          retrain=retrain_models):
+                if error is not None:
+                    st.error(f"❌ Ошибка загрузки {file_name}: {str(error)}")
+                    continue
+                
+                df_temp = analysis['df_processed']
+                store_analysis_result(file_name, df_temp, analysis)
+                cache_note = " (из кэша)" if analysis['from_cache'] else ""
+                st.success(f"✅ {file_name}: проанализировано за {analysis['execution_time']:.1f} сек{cache_note}")
+                files_to_analyze.append({'name': file_name, 'data': df_temp, 'processed': df_temp, 'analysis': analysis,
+                                         'position': position})
+        files_to_analyze.sort(key=lambda info: info['position'])
     
     for file_info in files_to_analyze:
         df = file_info['data']
@@ -1122,7 +1203,9 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
         
         try:
             with st.spinner("🔄 Загружаем и обрабатываем данные..."):
-                df_processed = preprocess(df)
+                df_processed = file_info.get('processed')
+                if df_processed is None:
+                    df_processed = preprocess(df)
             st.success("✅ Данные успешно загружены и обработаны!")
             st.markdown('<br>', unsafe_allow_html=True)
         except Exception as e:
@@ -1164,37 +1247,37 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
         try:
             with st.spinner("🧠 Анализируем транзакции на предмет мошенничества..."):
                 selected_models = st.session_state['confirmed_models'] if st.session_state.get('confirmed_models') else model_options
-                fraud_scores, anomalies, model_details = advanced_model_pipeline(
-                    df_processed, 
-                    model_types=selected_models,
-                    contamination=contamination_level
-                )
-                
-                rules_combined, rules_flags = rule_engine(df_processed)
-                
-                normalized_ml_scores = (fraud_scores - np.min(fraud_scores)) / (np.max(fraud_scores) - np.min(fraud_scores) + 1e-8)
-                combined_scores = 0.7 * normalized_ml_scores + 0.3 * rules_combined
+                analysis = file_info.get('analysis')
+                if analysis is None:
+                    file_hash = file_info['file_hash']
+                    feature_matrix, feature_columns = feature_matrix_store.get_or_write(df_processed, file_hash)
+                    feature_store = FeatureStore(feature_matrix, feature_columns, index=df_processed.index)
+                    analysis = {'feature_key': file_hash}
+                    analysis.update(score_frame(df_processed, selected_models, contamination_level, feature_store=feature_store,
+                                                data_key=file_hash, retrain=retrain_models,
+                                                amount_sketch=quantile_sketch_store.merged(file_info['file_hashes'], 'amount')))
+                    quantile_sketch_store.save(file_hash, analysis['quantile_sketches'])
+                    store_analysis_result(file_name, df, analysis)
+                else:
+                    feature_store = FeatureStore.from_key(analysis['feature_key'], index=df_processed.index)
                 
-                is_suspicious = combined_scores > np.percentile(combined_scores, 95)
+                fraud_scores = analysis['fraud_scores']
+                model_details = analysis['model_details']
+                rules_combined = analysis['rules_combined']
+                rules_mask = analysis['rules_mask']
+                combined_scores = analysis['combined_scores']
+                is_suspicious = analysis['is_suspicious']
                 suspicious_count = np.sum(is_suspicious)
                 
 
-                self_learning_results = integrate_self_learning(df_processed, combined_scores, is_suspicious)
-                
-                if 'analysis_results' not in st.session_state:
-                    st.session_state['analysis_results'] = {}
-                
-                st.session_state['analysis_results'][file_name] = {
-                    'total_transactions': len(df),
-                    'suspicious_count': int(suspicious_count),
-                    'clean_count': int(len(df) - suspicious_count),
-                    'fraud_percentage': (suspicious_count / len(df)) * 100,
-                    'combined_scores': combined_scores,
-                    'model_contributions': model_details if model_details else {},
-                    'is_suspicious': is_suspicious
-                }
+                self_learning_results = integrate_self_learning(df_processed, combined_scores, is_suspicious,
+                                                                feature_store=feature_store)
             
             st.success("✅ Анализ завершен!")
+            if promote_models and model_details:
+                promoted = model_registry.promote_models(model_details)
+                if promoted:
+                    st.info(f"📌 Эталонные модели: {', '.join(promoted)}")
             
             st.markdown('<h3>📊 Ключевые показатели:</h3>', unsafe_allow_html=True)
             col1, col2, col3, col4 = st.columns(4)
@@ -1302,16 +1385,18 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
                 suspicious_indices = np.where(is_suspicious)[0]
                 if len(suspicious_indices) > 0:
                     suspicious_data = []
-                    for idx in suspicious_indices[:20]:
+                    explanations = get_rule_explanations(rules_mask, rows=suspicious_indices[:20])
+                    for idx, explanation in zip(suspicious_indices[:20], explanations):
                         row = df.iloc[idx].to_dict()
                         row['fraud_score'] = combined_scores[idx]
+                        row['explanation'] = explanation
                         suspicious_data.append(row)
                     
                     suspicious_df = pd.DataFrame(suspicious_data)
                     if not suspicious_df.empty:
                         suspicious_df = suspicious_df.sort_values('fraud_score', ascending=False)
                         
-                        st.dataframe(suspicious_df[['step', 'type', 'amount', 'nameOrig', 'nameDest', 'fraud_score']].style.format({
+                        st.dataframe(suspicious_df[['step', 'type', 'amount', 'nameOrig', 'nameDest', 'fraud_score', 'explanation']].style.format({
                             'amount': '{:,.2f}',
                             'fraud_score': '{:.4f}'
                         }), use_container_width=True)
@@ -1405,6 +1490,30 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
                         """, unsafe_allow_html=True)
                 else:
                     st.info("Нет информации о моделях для отображения")
+                
+                rule_stats = analysis.get('rule_stats')
+                if rule_stats is not None:
+                    st.markdown('<h4>⚙️ Статистика правил</h4>', unsafe_allow_html=True)
+                    st.dataframe(rule_stats.to_frame().rename(columns={
+                        'rule': 'Правило',
+                        'wall_time_ms': 'Время, мс',
+                        'timed_rows': 'Строк в замере времени',
+                        'rows_evaluated': 'Проверено строк',
+                        'hits': 'Срабатываний',
+                        'hit_rate': 'Доля срабатываний',
+                        'anomaly_overlap': 'Совпадение с ML',
+                        'anomaly_coverage': 'Покрытие аномалий ML',
+                        'ns_per_row': 'нс на строку'
+                    }).style.format({
+                        'Время, мс': '{:.2f}',
+                        'Доля срабатываний': '{:.2%}',
+                        'Совпадение с ML': '{:.2%}',
+                        'Покрытие аномалий ML': '{:.2%}',
+                        'нс на строку': '{:.1f}'
+                    }), use_container_width=True)
+                    dead_rules = rule_stats.dead_rules()
+                    if dead_rules:
+                        st.caption(f"Правила без срабатываний: {', '.join(dead_rules)}")
             with tab4:
                 st.markdown('<h3>💳 Анализ по типам транзакций</h3>', unsafe_allow_html=True)
                 
@@ -1539,6 +1648,39 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
             
             st.markdown('</div>', unsafe_allow_html=True)
             
+            if full_scoring_mode:
+                st.markdown('<h2>🧮 Полная оценка всех транзакций</h2>', unsafe_allow_html=True)
+                try:
+                    progress_text, progress_bar = progress_manager.create_animated_progress_bar("Оценка транзакций")
+                    
+                    def update_scoring_progress(rows_scored, total_rows):
+                        ingest_stats = data_processor.get_ingest_stats()
+                        progress_manager.update_progress(
+                            progress_text, progress_bar, rows_scored, total_rows or rows_scored,
+                            f"Оценено транзакций ({ingest_stats.get('rows_per_sec', 0):,.0f} строк/с)"
+                        )
+                    
+                    safe_name = os.path.splitext(os.path.basename(file_name))[0]
+                    scoring_summary = score_all_rows(
+                        df,
+                        os.path.join("scored_output", f"scored_{safe_name}.csv"),
+                        model_types=st.session_state['confirmed_models'] if st.session_state.get('confirmed_models') else model_options,
+                        contamination=contamination_level,
+                        progress_callback=update_scoring_progress
+                    )
+                    st.success(f"✅ Оценено {scoring_summary['rows_scored']:,} транзакций за {scoring_summary['execution_time']:.1f} сек. "
+                               f"Подозрительных: {scoring_summary['suspicious_count']:,}")
+                    with open(scoring_summary['output_path'], 'rb') as scored_file:
+                        st.download_button(
+                            label="📥 Скачать полную оценку (CSV)",
+                            data=scored_file,
+                            file_name=os.path.basename(scoring_summary['output_path']),
+                            mime="text/csv",
+                            key=f"full_scoring_download_{safe_name}"
+                        )
+                except Exception as e:
+                    st.error(f"❌ Ошибка полной оценки: {str(e)}")
+            
             st.markdown('<h2>📤 Экспорт результатов</h2>', unsafe_allow_html=True)
             st.markdown('<div style="background: linear-gradient(135deg, rgba(56, 239, 125, 0.1) 0%, rgba(17, 153, 142, 0.1) 100%); padding: 30px; border-radius: 20px; margin: 20px 0;">', unsafe_allow_html=True)
             
@@ -1578,6 +1720,8 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
                                 return "Низкий"
                         
                         export_data['risk_level'] = [get_risk_level(score) for score in adjusted_scores]
+                        if len(rules_mask) == len(df):
+                            export_data['explanation'] = get_rule_explanations(rules_mask)
                         
                         if export_format == "HTML отчет":
                             try:
@@ -1586,7 +1730,7 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
                                     adjusted_scores, 
                                     adjusted_suspicious, 
                                     model_details, 
-                                    rules_flags,
+                                    rules_mask,
                                     file_name
                                 )
                                 st.download_button(
@@ -1651,18 +1795,24 @@ if st.session_state.get('confirmed_files') and st.session_state.get('uploaded_fi
                                         "low_risk": int(np.sum(adjusted_scores <= 0.4))
                                     },
                                     "model_details": model_details,
+                                    "rule_performance": analysis['rule_stats'].to_dict() if analysis.get('rule_stats') is not None else [],
                                     "top_suspicious_transactions": []
                                 }
                                 
                                 suspicious_indices = np.where(adjusted_suspicious)[0]
                                 top_suspicious = sorted(suspicious_indices, key=lambda x: adjusted_scores[x], reverse=True)[:20]
                                 
-                                for idx in top_suspicious:
+                                mask_rows = df_processed.index.get_indexer(df.index[top_suspicious])
+                                matched_rows = mask_rows >= 0
+                                top_explanations = np.full(len(top_suspicious), "N/A", dtype=object)
+                                top_explanations[matched_rows] = get_rule_explanations(rules_mask, rows=mask_rows[matched_rows])
+                                for idx, explanation in zip(top_suspicious, top_explanations):
                                     if idx < len(df):
                                         transaction_info = {
                                             "transaction_id": int(idx),
                                             "fraud_score": float(adjusted_scores[idx]),
-                                            "risk_level": get_risk_level(adjusted_scores[idx])
+                                            "risk_level": get_risk_level(adjusted_scores[idx]),
+                                            "explanation": explanation
                                         }
                                         
                                         for col in ['step', 'type', 'amount', 'nameOrig', 'nameDest']:
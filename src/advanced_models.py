@@ -10,15 +10,54 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
 import warnings
 import time
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import networkx as nx
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
 import json
+from src.feature_store import FeatureStore, get_feature_columns, is_constant_matrix, iter_row_slices
+from src.resource_governor import resource_governor
+from src.model_registry import model_registry
+from src.fingerprint import file_fingerprinter
+from src.preprocessing import customer_order
 warnings.filterwarnings('ignore')
 
-class AutoEncoder(nn.Module):
+SCORING_BATCH_ROWS = 50000
+DECISION_CLIP = 10.0
+SEQUENCE_COLUMNS = ['amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
+
+# autoencoder training: held-out share, epochs without improvement, relative improvement that counts
+AE_VALIDATION_FRACTION = 0.1
+AE_PATIENCE = 2
+AE_MIN_IMPROVEMENT = 1e-3
+AE_TIME_BUDGET_S = 30.0
+AE_PARITY_ROWS = 5000
+
+class StandardizedAutoEncoder(nn.Module):
+    """Autoencoder that keeps the training mean/scale as buffers, so they travel with its state_dict"""
+
+    def __init__(self, input_dim):
+        super(StandardizedAutoEncoder, self).__init__()
+        self.register_buffer('feature_mean', torch.zeros(input_dim))
+        self.register_buffer('feature_scale', torch.ones(input_dim))
+
+    def fit_scaler(self, X_tensor):
+        std, mean = torch.std_mean(X_tensor.double(), dim=0, unbiased=False)
+        self.feature_mean.copy_(mean.float())
+        self.feature_scale.copy_(torch.where(std > 0, std, torch.ones_like(std)).float())
+
+    def standardize(self, x):
+        return (x - self.feature_mean) / self.feature_scale
+
+    def reconstruction_error(self, x):
+        standardized = self.standardize(x)
+        return torch.mean((self(standardized) - standardized) ** 2, dim=1)
+
+class AutoEncoder(StandardizedAutoEncoder):
     def __init__(self, input_dim, hidden_dim=32, latent_dim=16):
-        super(AutoEncoder, self).__init__()
+        super(AutoEncoder, self).__init__(input_dim)
         self.encoder = nn.Sequential(
             nn.Linear(input_dim, hidden_dim),
             nn.ReLU(),
@@ -29,8 +68,7 @@ class AutoEncoder(nn.Module):
         self.decoder = nn.Sequential(
             nn.Linear(latent_dim, hidden_dim),
             nn.ReLU(),
-            nn.Linear(hidden_dim, input_dim),
-            nn.Sigmoid()
+            nn.Linear(hidden_dim, input_dim)
         )
     
     def forward(self, x):
@@ -59,9 +97,9 @@ class LSTMAutoEncoder(nn.Module):
         
         return out
 
-class FastAutoEncoder(nn.Module):
+class FastAutoEncoder(StandardizedAutoEncoder):
     def __init__(self, input_dim, hidden_dim=16, latent_dim=8):
-        super(FastAutoEncoder, self).__init__()
+        super(FastAutoEncoder, self).__init__(input_dim)
         self.encoder = nn.Sequential(
             nn.Linear(input_dim, hidden_dim),
             nn.ReLU(),
@@ -72,8 +110,7 @@ class FastAutoEncoder(nn.Module):
         self.decoder = nn.Sequential(
             nn.Linear(latent_dim, hidden_dim),
             nn.ReLU(),
-            nn.Linear(hidden_dim, input_dim),
-            nn.Sigmoid()
+            nn.Linear(hidden_dim, input_dim)
         )
     
     def forward(self, x):
@@ -102,6 +139,10 @@ class FastLSTMAutoEncoder(nn.Module):
         
         return out
 
+def as_float_tensor(X):
+    """float32 tensor sharing memory with X whenever X is already a contiguous float32 array"""
+    return torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+
 def prepare_sequences(df, sequence_length=5):
     sequences = []
     targets = []
@@ -125,27 +166,28 @@ def prepare_sequences_fast(df, sequence_length=3, sample_ratio=0.3):
     sequences = []
     targets = []
 
-    unique_customers = df['nameOrig'].unique()
-    if len(unique_customers) > 100:
-        sampled_customers = np.random.choice(unique_customers, 
-                                           size=int(len(unique_customers) * sample_ratio), 
-                                           replace=False)
+    order, _, _, group_start = customer_order(df)
+    data = df[SEQUENCE_COLUMNS].to_numpy()[order]
+    
+    group_starts = np.flatnonzero(group_start == np.arange(len(order)))
+    group_sizes = np.diff(np.append(group_starts, len(order)))
+    
+    if len(group_starts) > 100:
+        sampled_groups = np.random.choice(len(group_starts), 
+                                         size=int(len(group_starts) * sample_ratio), 
+                                         replace=False)
     else:
-        sampled_customers = unique_customers[:50]  
+        sampled_groups = np.arange(len(group_starts))[:50]  
     
-    for customer_id in sampled_customers:
-        customer_data = df[df['nameOrig'] == customer_id].sort_values('step')
-        if len(customer_data) < sequence_length:
+    for group in sampled_groups:
+        start, size = group_starts[group], group_sizes[group]
+        if size < sequence_length:
             continue
-            
-        feature_cols = ['amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
-        data = customer_data[feature_cols].values
         
-        
-        max_sequences_per_customer = min(5, len(data) - sequence_length + 1)
-        for i in range(min(max_sequences_per_customer, len(data) - sequence_length + 1)):
-            sequences.append(data[i:i+sequence_length])
-            targets.append(data[i+sequence_length-1])
+        max_sequences_per_customer = min(5, size - sequence_length + 1)
+        for i in range(max_sequences_per_customer):
+            sequences.append(data[start + i:start + i + sequence_length])
+            targets.append(data[start + i + sequence_length - 1])
             
             
             if len(sequences) >= 100: 
@@ -156,61 +198,84 @@ def prepare_sequences_fast(df, sequence_length=3, sample_ratio=0.3):
     
     return np.array(sequences), np.array(targets)
 
-def train_autoencoder(X, epochs=20, batch_size=64, learning_rate=0.001):
-    X_tensor = torch.FloatTensor(X)
+def fit_autoencoder(model, X, epochs, batch_size, learning_rate, weight_decay=0.0,
+                    patience=AE_PATIENCE, time_budget_s=AE_TIME_BUDGET_S, seed=42):
+    """Train on one standardized float32 tensor with index-permutation batches; stops on a
+    validation-loss plateau or when the time budget runs out and keeps the best weights"""
+    started_at = time.perf_counter()
+    generator = torch.Generator().manual_seed(seed)
     
-    dataset = TensorDataset(X_tensor, X_tensor)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    X_tensor = as_float_tensor(X)
+    model.fit_scaler(X_tensor)
+    with torch.no_grad():
+        X_tensor = model.standardize(X_tensor)
+    
+    order = torch.randperm(len(X_tensor), generator=generator)
+    n_validation = int(len(X_tensor) * AE_VALIDATION_FRACTION) if len(X_tensor) >= 200 else 0
+    X_validation = X_tensor[order[:n_validation]]
+    X_train = X_tensor[order[n_validation:]]
     
-    model = AutoEncoder(X.shape[1])
     criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
     
-    model.train()
+    best_loss = np.inf
+    best_state = None
+    stale_epochs = 0
+    out_of_time = False
     for epoch in range(epochs):
-        total_loss = 0
-        for batch_x, _ in dataloader:
+        model.train()
+        permutation = torch.randperm(len(X_train), generator=generator)
+        for start in range(0, len(X_train), batch_size):
+            batch_x = X_train[permutation[start:start + batch_size]]
             optimizer.zero_grad()
-            reconstructed = model(batch_x)
-            loss = criterion(reconstructed, batch_x)
+            loss = criterion(model(batch_x), batch_x)
             loss.backward()
             optimizer.step()
-            total_loss += loss.item()
+            if time_budget_s is not None and time.perf_counter() - started_at > time_budget_s:
+                out_of_time = True
+                break
+        
+        if n_validation == 0:
+            if out_of_time:
+                break
+            continue
+        
+        model.eval()
+        with torch.no_grad():
+            validation_loss = criterion(model(X_validation), X_validation).item()
+        if validation_loss < best_loss * (1 - AE_MIN_IMPROVEMENT):
+            best_loss = validation_loss
+            best_state = {name: value.clone() for name, value in model.state_dict().items()}
+            stale_epochs = 0
+        else:
+            stale_epochs += 1
+        if out_of_time or stale_epochs >= patience:
+            break
     
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    model.eval()
     return model
 
-def train_autoencoder_fast(X, epochs=10, batch_size=128, learning_rate=0.001):
+def train_autoencoder(X, epochs=20, batch_size=64, learning_rate=0.001, time_budget_s=AE_TIME_BUDGET_S):
+    model = AutoEncoder(X.shape[1])
+    return fit_autoencoder(model, X, epochs, batch_size, learning_rate, time_budget_s=time_budget_s)
+
+def train_autoencoder_fast(X, epochs=10, batch_size=128, learning_rate=0.001, time_budget_s=AE_TIME_BUDGET_S):
     """Faster autoencoder training with optimized parameters"""
-    if X.shape[0] > 10000:
-        sample_indices = np.random.choice(X.shape[0], size=10000, replace=False)
+    sample_size = resource_governor.sample_size('autoencoder', X.shape[0])
+    if X.shape[0] > sample_size:
+        sample_indices = np.sort(np.random.choice(X.shape[0], size=sample_size, replace=False))
         X_sampled = X[sample_indices]
     else:
         X_sampled = X
     
-    X_tensor = torch.FloatTensor(X_sampled)
-    
-    dataset = TensorDataset(X_tensor, X_tensor)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0)
-    
     model = FastAutoEncoder(X_sampled.shape[1], hidden_dim=16, latent_dim=8)
-    criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
-    
-    model.train()
-    for epoch in range(epochs):
-        total_loss = 0
-        for batch_x, _ in dataloader:
-            optimizer.zero_grad()
-            reconstructed = model(batch_x)
-            loss = criterion(reconstructed, batch_x)
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item()
-    
-    return model
+    return fit_autoencoder(model, X_sampled, epochs, batch_size, learning_rate, weight_decay=1e-5,
+                           time_budget_s=time_budget_s)
 
 def train_lstm_autoencoder(sequences, epochs=15, batch_size=32, learning_rate=0.001):
-    seq_tensor = torch.FloatTensor(sequences)
+    seq_tensor = as_float_tensor(sequences)
     
     dataset = TensorDataset(seq_tensor, seq_tensor)
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
@@ -242,7 +307,7 @@ def train_lstm_autoencoder_fast(sequences, epochs=8, batch_size=32, learning_rat
         indices = np.random.choice(len(sequences), size=200, replace=False)
         sequences = sequences[indices]
     
-    seq_tensor = torch.FloatTensor(sequences)
+    seq_tensor = as_float_tensor(sequences)
     
     dataset = TensorDataset(seq_tensor, seq_tensor)
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0)
@@ -267,34 +332,74 @@ def train_lstm_autoencoder_fast(sequences, epochs=8, batch_size=32, learning_rat
 def autoencoder_anomaly_scores(model, X):
     model.eval()
     with torch.no_grad():
-        X_tensor = torch.FloatTensor(X)
-        reconstructed = model(X_tensor)
-        mse = torch.mean((reconstructed - X_tensor) ** 2, dim=1)
-        return mse.numpy()
+        return model.reconstruction_error(as_float_tensor(X)).numpy()
 
-def autoencoder_anomaly_scores_fast(model, X):
-    """Faster anomaly scoring for autoencoder"""
+class ReconstructionErrorScorer(nn.Module):
+    """Inference graph of a trained autoencoder: raw feature rows in, per-row reconstruction error out"""
+
+    def __init__(self, model):
+        super(ReconstructionErrorScorer, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.reconstruction_error(x)
+
+def export_autoencoder(model, path=None):
+    """Frozen TorchScript scoring graph of a trained autoencoder; saved when path is given"""
     model.eval()
+    example = torch.zeros(64, model.feature_mean.shape[0])
     with torch.no_grad():
-        X_tensor = torch.FloatTensor(X)
-        if X_tensor.shape[0] > 5000:
-            scores = []
-            batch_size = 1000
-            for i in range(0, X_tensor.shape[0], batch_size):
-                batch = X_tensor[i:i+batch_size]
-                reconstructed = model(batch)
-                mse = torch.mean((reconstructed - batch) ** 2, dim=1)
-                scores.append(mse.numpy())
-            return np.concatenate(scores)
-        else:
-            reconstructed = model(X_tensor)
-            mse = torch.mean((reconstructed - X_tensor) ** 2, dim=1)
-            return mse.numpy()
+        scorer = torch.jit.freeze(torch.jit.trace(ReconstructionErrorScorer(model).eval(), example))
+    if path:
+        torch.jit.save(scorer, path)
+    return scorer
+
+def load_exported_autoencoder(path):
+    return torch.jit.load(path).eval()
+
+def exported_anomaly_scores(scorer, X, batch_rows=SCORING_BATCH_ROWS):
+    """Run an exported scoring graph over X (e.g. the memmapped feature matrix) slice by slice"""
+    scores = np.empty(X.shape[0], dtype=np.float32)
+    with torch.inference_mode():
+        for start, block in iter_row_slices(X, batch_rows):
+            scores[start:start + len(block)] = scorer(as_float_tensor(block)).numpy()
+    return scores
+
+def check_export_parity(model, scorer, X, max_rows=AE_PARITY_ROWS):
+    """Compare an exported graph with the eager model on the first rows of X"""
+    X_check = np.asarray(X[:max_rows])
+    model.eval()
+    with torch.no_grad():
+        eager_scores = model.reconstruction_error(as_float_tensor(X_check)).numpy()
+    exported_scores = exported_anomaly_scores(scorer, X_check)
+    
+    errors = np.abs(exported_scores.astype(np.float64) - eager_scores)
+    eager_ranks = np.argsort(np.argsort(eager_scores))
+    exported_ranks = np.argsort(np.argsort(exported_scores))
+    rank_correlation = np.corrcoef(eager_ranks, exported_ranks)[0, 1] if len(X_check) > 1 else 1.0
+    return {
+        'rows': len(X_check),
+        'max_abs_error': float(errors.max()) if len(errors) else 0.0,
+        'max_rel_error': float((errors / (np.abs(eager_scores) + 1e-8)).max()) if len(errors) else 0.0,
+        'rank_correlation': float(rank_correlation)
+    }
+
+# exported graphs per trained model, so warm-loaded registry models are traced once per process
+exported_scorers = weakref.WeakKeyDictionary()
+
+def exported_scorer(model):
+    if model not in exported_scorers:
+        exported_scorers[model] = export_autoencoder(model)
+    return exported_scorers[model]
+
+def autoencoder_anomaly_scores_fast(model, X):
+    """Faster anomaly scoring for autoencoder"""
+    return exported_anomaly_scores(exported_scorer(model), X)
 
 def lstm_anomaly_scores(model, sequences):
     model.eval()
     with torch.no_grad():
-        seq_tensor = torch.FloatTensor(sequences)
+        seq_tensor = as_float_tensor(sequences)
         reconstructed = model(seq_tensor)
         mse = torch.mean((reconstructed - seq_tensor) ** 2, dim=2)
         return torch.mean(mse, dim=1).numpy()
@@ -306,7 +411,7 @@ def lstm_anomaly_scores_fast(model, sequences):
         
     model.eval()
     with torch.no_grad():
-        seq_tensor = torch.FloatTensor(sequences)
+        seq_tensor = as_float_tensor(sequences)
         reconstructed = model(seq_tensor)
         mse = torch.mean((reconstructed - seq_tensor) ** 2, dim=2)
         return torch.mean(mse, dim=1).numpy()
@@ -324,87 +429,127 @@ def combined_isolation_forest_lof(X, contamination=0.05):
     
     return -combined_scores, anomalies
 
-def combined_isolation_forest_lof_fast(X, contamination=0.05):
-    """Optimized Isolation Forest and LOF combination"""
-    if X.shape[0] > 5000:
-        sample_size = min(5000, X.shape[0])
-        indices = np.random.choice(X.shape[0], size=sample_size, replace=False)
-        X_sampled = X[indices]
-    else:
-        X_sampled = X
+def robust_scale(values):
+    """Median absolute deviation, scaled to match the standard deviation of normal data"""
+    return 1.4826 * np.median(np.abs(values - np.median(values))) + 1e-8
+
+def score_in_batches(score_fn, X, batch_rows=SCORING_BATCH_ROWS):
+    """Apply a per-row scoring function to every row, slice by slice, over a thread pool"""
+    scores = np.empty(X.shape[0], dtype=np.float64)
+    slices = list(iter_row_slices(X, batch_rows))
+    task_mb = batch_rows * max(X.shape[1], 1) * 8 / 1024 / 1024
+    workers = resource_governor.worker_count(len(slices), task_mb=task_mb)
     
+    def score_slice(item):
+        start, block = item
+        scores[start:start + len(block)] = score_fn(np.asarray(block))
+    
+    if workers == 1:
+        for item in slices:
+            score_slice(item)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(score_slice, slices))
+    return scores
 
+def fit_isolation_forest_lof(X, contamination=0.05):
+    """Isolation Forest and novelty-mode LOF fitted on samples, with the spreads used to put them on one scale"""
+    rng = np.random.default_rng(42)
+    sample_size = resource_governor.sample_size('isolation_forest', X.shape[0])
+    if X.shape[0] > sample_size:
+        X_sampled = np.asarray(X[np.sort(rng.choice(X.shape[0], size=sample_size, replace=False))])
+    else:
+        X_sampled = np.asarray(X)
+    
     iso_forest = IsolationForest(contamination=contamination, random_state=42, n_estimators=30, max_samples='auto')
-    iso_scores = iso_forest.fit_predict(X_sampled)
+    iso_forest.fit(X_sampled)
     
-
-    if X_sampled.shape[0] > 1000:
-        lof_sample_size = min(1000, X_sampled.shape[0])
-        lof_indices = np.random.choice(X_sampled.shape[0], size=lof_sample_size, replace=False)
-        X_lof = X_sampled[lof_indices]
-        lof_full_indices = lof_indices
+    lof_sample_size = resource_governor.sample_size('lof', X_sampled.shape[0])
+    if X_sampled.shape[0] > lof_sample_size:
+        X_lof = X_sampled[np.sort(rng.choice(X_sampled.shape[0], size=lof_sample_size, replace=False))]
     else:
         X_lof = X_sampled
-        lof_full_indices = np.arange(X_sampled.shape[0])
     
-    lof = LocalOutlierFactor(n_neighbors=5, contamination=contamination)
-    lof_scores = lof.fit_predict(X_lof)
+    lof = LocalOutlierFactor(n_neighbors=5, contamination=contamination, novelty=True)
+    lof.fit(X_lof)
     
+    # decision values are negative for outliers; LOF's are unbounded, so both are put on a robust common scale
+    return {
+        'isolation_forest': iso_forest,
+        'lof': lof,
+        'iso_scale': robust_scale(iso_forest.decision_function(X_sampled)),
+        'lof_scale': robust_scale(lof.decision_function(X_lof))
+    }
 
-    if len(lof_full_indices) != len(X_sampled):
-        full_lof_scores = np.zeros(len(X_sampled))
-        full_lof_scores[lof_full_indices] = lof_scores
-        lof_scores = full_lof_scores
+def combined_isolation_forest_lof_fast(X, contamination=0.05, engine=None):
+    """Score every row in parallel batches with a fitted (or freshly fitted) Isolation Forest + LOF engine"""
+    engine = engine or fit_isolation_forest_lof(X, contamination=contamination)
     
-    combined_scores = (iso_scores + lof_scores) / 2
+    iso_decision = score_in_batches(engine['isolation_forest'].decision_function, X)
+    lof_decision = score_in_batches(engine['lof'].decision_function, X)
     
-    anomalies = (combined_scores < 0).astype(int)
+    combined_scores = (np.clip(iso_decision / engine['iso_scale'], -DECISION_CLIP, DECISION_CLIP) +
+                       np.clip(lof_decision / engine['lof_scale'], -DECISION_CLIP, DECISION_CLIP)) / 2
+    anomalies = ((iso_decision < 0) & (lof_decision < 0)).astype(int)
     
+    return -combined_scores, anomalies
 
-    if len(X_sampled) != len(X):
-        repeat_factor = len(X) // len(X_sampled)
-        remainder = len(X) % len(X_sampled)
-        
-        extended_scores = np.tile(-combined_scores, repeat_factor)
-        extended_anomalies = np.tile(anomalies, repeat_factor)
-        
-        if remainder > 0:
-            extended_scores = np.concatenate([extended_scores, -combined_scores[:remainder]])
-            extended_anomalies = np.concatenate([extended_anomalies, anomalies[:remainder]])
-            
-        return extended_scores, extended_anomalies
+TORCH_MEMBERS = ('autoencoder', 'lstm')
+
+def run_ensemble_members(members):
+    """Run (name, fn) ensemble members concurrently in threads; returns {name: (result, timing)} in member order.
+    sklearn and torch both release the GIL in their heavy loops; torch intra-op threads are pinned to
+    the share of the process's thread budget left over by the sklearn members while they run side by side.
+    dispatch_cpu_time counts only the member's own thread, not its nested pools or torch intra-op threads."""
+    if not members:
+        return {}
     
-    return -combined_scores, anomalies
+    previous_torch_threads = torch.get_num_threads()
+    torch_members = sum(name in TORCH_MEMBERS for name, _ in members)
+    if torch_members and torch_members < len(members):
+        torch.set_num_threads(max(1, previous_torch_threads - (len(members) - torch_members)))
+    
+    def timed(run_member, submitted_at):
+        started_at = time.perf_counter()
+        cpu_started = time.thread_time()
+        result = run_member()
+        return result, {
+            'queue_wait': started_at - submitted_at,
+            'execution_time': time.perf_counter() - started_at,
+            'dispatch_cpu_time': time.thread_time() - cpu_started
+        }
+    
+    try:
+        with ThreadPoolExecutor(max_workers=len(members)) as executor:
+            futures = [(name, executor.submit(timed, run_member, time.perf_counter())) for name, run_member in members]
+            return {name: future.result() for name, future in futures}
+    finally:
+        torch.set_num_threads(previous_torch_threads)
 
-def advanced_model_pipeline(df, model_types=['isolation_forest', 'autoencoder'], contamination=0.05):
+def advanced_model_pipeline(df, model_types=['isolation_forest', 'autoencoder'], contamination=0.05, feature_store=None,
+                            data_key=None, retrain=False):
+    """Score with registered models when a compatible one exists; train (and register) only when none does or on retrain"""
     start_time = time.time()
     
     try:
         if not (0 < contamination <= 0.5):
             raise ValueError("Уровень ожидаемого мошенничества должен быть между 0 и 0.5")
         
-        exclude_cols = ['step', 'type', 'nameOrig', 'nameDest', 'isFraud', 'isFlaggedFraud']
-        feature_cols = [col for col in df.columns if col not in exclude_cols]
-        
-        if len(feature_cols) == 0:
-            raise ValueError("Нет допустимых признаков для анализа. Проверьте, что файл содержит числовые данные.")
-        
-        X_df = df[feature_cols].copy()
-        for col in X_df.columns:
-            X_df[col] = pd.to_numeric(X_df[col], errors='coerce')
-        
-        X_df = X_df.fillna(0)
+        if feature_store is None:
+            feature_cols = get_feature_columns(df)
+            
+            if len(feature_cols) == 0:
+                raise ValueError("Нет допустимых признаков для анализа. Проверьте, что файл содержит числовые данные.")
+            
+            feature_store = FeatureStore.from_frame(df, feature_cols)
         
-        X = X_df.values.astype(np.float64)
+        X = feature_store.matrix
         
         if X.size == 0 or X.shape[0] == 0:
             raise ValueError("Нет допустимых числовых данных для анализа. Проверьте формат данных.")
         
         
-        X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
-        
-        
-        if np.all(X == X[0]) if X.size > 0 else False:
+        if is_constant_matrix(X):
             raise ValueError("Все значения в данных постоянны. Невозможно выполнить анализ.")
         
         scores_list = []
@@ -413,112 +558,121 @@ def advanced_model_pipeline(df, model_types=['isolation_forest', 'autoencoder'],
         
       
         dataset_size = X.shape[0]
+        data_fingerprint = data_key or file_fingerprinter.fingerprint_buffer(np.ascontiguousarray(X))
         
-        if 'isolation_forest' in model_types:
+        def align(scores, anomalies):
+            if len(scores) > dataset_size:
+                return scores[:dataset_size], anomalies[:dataset_size]
+            if len(scores) < dataset_size:
+                extension = np.full(dataset_size - len(scores), np.mean(scores) if len(scores) > 0 else 0)
+                extension_anomalies = np.full(dataset_size - len(anomalies), int(np.mean(anomalies)) if len(anomalies) > 0 else 0)
+                return np.concatenate([scores, extension]), np.concatenate([anomalies, extension_anomalies])
+            return scores, anomalies
+        
+        def run_isolation_forest():
             try:
-                iso_start = time.time()
-                iso_scores, iso_anomalies = combined_isolation_forest_lof_fast(X, contamination=contamination)
-                iso_time = time.time() - iso_start
-                
-                
-                if len(iso_scores) != dataset_size:
-                    if len(iso_scores) > dataset_size:
-                        iso_scores = iso_scores[:dataset_size]
-                        iso_anomalies = iso_anomalies[:dataset_size]
-                    else:
-                        extension = np.full(dataset_size - len(iso_scores), np.mean(iso_scores) if len(iso_scores) > 0 else 0)
-                        iso_scores = np.concatenate([iso_scores, extension])
-                        extension_anomalies = np.full(dataset_size - len(iso_anomalies), int(np.mean(iso_anomalies)) if len(iso_anomalies) > 0 else 0)
-                        iso_anomalies = np.concatenate([iso_anomalies, extension_anomalies])
-                
-                scores_list.append(iso_scores)
-                anomalies_list.append(iso_anomalies)
-                model_details['isolation_forest'] = {
+                engine, iso_entry, iso_trained = model_registry.get_or_train(
+                    'isolation_forest_lof', lambda: fit_isolation_forest_lof(X, contamination=contamination),
+                    feature_store.columns, {'contamination': contamination, 'n_estimators': 30}, data_fingerprint,
+                    retrain=retrain, training_rows=dataset_size
+                )
+                iso_scores, iso_anomalies = align(*combined_isolation_forest_lof_fast(X, contamination=contamination, engine=engine))
+                return {
                     'scores': iso_scores,
                     'anomalies': iso_anomalies,
                     'weight': 0.4,
-                    'execution_time': iso_time
+                    'trained': iso_trained,
+                    'model_version': iso_entry['version'] if iso_entry else None,
+                    'model_key': iso_entry['key'] if iso_entry else None
                 }
             except Exception as e:
                 print(f"Warning: Isolation Forest model failed: {str(e)}")
         
-    
-        if 'autoencoder' in model_types and dataset_size > 50:
+        def run_autoencoder():
             try:
-                ae_start = time.time()
-                ae_model = train_autoencoder_fast(X, epochs=10 if dataset_size > 1000 else 5)
+                ae_epochs = 10 if dataset_size > 1000 else 5
+                ae_model, ae_entry, ae_trained = model_registry.get_or_train(
+                    'autoencoder', lambda: train_autoencoder_fast(X, epochs=ae_epochs),
+                    feature_store.columns, {'epochs': ae_epochs, 'hidden_dim': 16, 'latent_dim': 8, 'standardized': True,
+                     'patience': AE_PATIENCE}, data_fingerprint,
+                    retrain=retrain, module_class=FastAutoEncoder,
+                    init_args={'input_dim': X.shape[1], 'hidden_dim': 16, 'latent_dim': 8}, training_rows=dataset_size
+                )
                 ae_scores = autoencoder_anomaly_scores_fast(ae_model, X)
-                ae_anomalies = (ae_scores > np.percentile(ae_scores, 95)).astype(int)
-                ae_time = time.time() - ae_start
-              
-                if len(ae_scores) != dataset_size:
-                    if len(ae_scores) > dataset_size:
-                        ae_scores = ae_scores[:dataset_size]
-                        ae_anomalies = ae_anomalies[:dataset_size]
-                    else:
-                        extension = np.full(dataset_size - len(ae_scores), np.mean(ae_scores) if len(ae_scores) > 0 else 0)
-                        ae_scores = np.concatenate([ae_scores, extension])
-                        extension_anomalies = np.full(dataset_size - len(ae_anomalies), int(np.mean(ae_anomalies)) if len(ae_anomalies) > 0 else 0)
-                        ae_anomalies = np.concatenate([ae_anomalies, extension_anomalies])
-                
-                scores_list.append(ae_scores)
-                anomalies_list.append(ae_anomalies)
-                model_details['autoencoder'] = {
+                ae_scores, ae_anomalies = align(ae_scores, (ae_scores > np.percentile(ae_scores, 95)).astype(int))
+                return {
                     'scores': ae_scores,
                     'anomalies': ae_anomalies,
                     'weight': 0.3,
-                    'execution_time': ae_time
+                    'trained': ae_trained,
+                    'model_version': ae_entry['version'] if ae_entry else None,
+                    'model_key': ae_entry['key'] if ae_entry else None
                 }
             except Exception as e:
                 print(f"Warning: AutoEncoder model failed: {str(e)}")
         
-
-        if 'lstm' in model_types and dataset_size > 100:
+        def run_lstm():
             try:
-                lstm_start = time.time()
-                sequences, _ = prepare_sequences_fast(df, sequence_length=min(3, max(1, dataset_size // 50)))
-                if len(sequences) > 0:
-                    lstm_model = train_lstm_autoencoder_fast(sequences, epochs=8 if dataset_size > 1000 else 5)
-                    lstm_scores = lstm_anomaly_scores_fast(lstm_model, sequences)
-                    
-                    if len(lstm_scores) > 0:
-                        lstm_anomalies = (lstm_scores > np.percentile(lstm_scores, 95)).astype(int)
-                     
-                        expansion_factor = dataset_size // len(lstm_scores) if len(lstm_scores) > 0 else 1
-                        if expansion_factor > 1:
-                            expanded_scores = np.repeat(lstm_scores, expansion_factor)[:dataset_size]
-                            expanded_anomalies = np.repeat(lstm_anomalies, expansion_factor)[:dataset_size]
-                        else:
-                           
-                            expanded_scores = np.interp(np.linspace(0, len(lstm_scores)-1, dataset_size), 
-                                                      np.arange(len(lstm_scores)), lstm_scores)
-                            expanded_anomalies = (expanded_scores > np.percentile(lstm_scores, 95)).astype(int)
-                        
-                        lstm_time = time.time() - lstm_start
-                        scores_list.append(expanded_scores)
-                        anomalies_list.append(expanded_anomalies)
-                        model_details['lstm'] = {
-                            'scores': expanded_scores,
-                            'anomalies': expanded_anomalies,
-                            'weight': 0.3,
-                            'execution_time': lstm_time
-                        }
-                else:
-                  
+                sequence_length = min(3, max(1, dataset_size // 50))
+                sequences, _ = prepare_sequences_fast(df, sequence_length=sequence_length)
+                if len(sequences) == 0:
                     fallback_scores = np.random.rand(dataset_size) * 0.1
-                    fallback_anomalies = (fallback_scores > np.percentile(fallback_scores, 95)).astype(int)
-                    lstm_time = time.time() - lstm_start
-                    scores_list.append(fallback_scores)
-                    anomalies_list.append(fallback_anomalies)
-                    model_details['lstm'] = {
+                    return {
                         'scores': fallback_scores,
-                        'anomalies': fallback_anomalies,
-                        'weight': 0.3,
-                        'execution_time': lstm_time
+                        'anomalies': (fallback_scores > np.percentile(fallback_scores, 95)).astype(int),
+                        'weight': 0.3
                     }
+                
+                lstm_epochs = 8 if dataset_size > 1000 else 5
+                lstm_model, lstm_entry, lstm_trained = model_registry.get_or_train(
+                    'lstm', lambda: train_lstm_autoencoder_fast(sequences, epochs=lstm_epochs),
+                    SEQUENCE_COLUMNS, {'epochs': lstm_epochs, 'hidden_dim': 16, 'num_layers': 1,
+                                       'sequence_length': sequence_length}, data_fingerprint,
+                    retrain=retrain, module_class=FastLSTMAutoEncoder,
+                    init_args={'input_dim': sequences.shape[2], 'hidden_dim': 16, 'num_layers': 1},
+                    training_rows=len(sequences)
+                )
+                lstm_scores = lstm_anomaly_scores_fast(lstm_model, sequences)
+                if len(lstm_scores) == 0:
+                    return None
+                
+                lstm_anomalies = (lstm_scores > np.percentile(lstm_scores, 95)).astype(int)
+                expansion_factor = dataset_size // len(lstm_scores)
+                if expansion_factor > 1:
+                    expanded_scores = np.repeat(lstm_scores, expansion_factor)[:dataset_size]
+                    expanded_anomalies = np.repeat(lstm_anomalies, expansion_factor)[:dataset_size]
+                else:
+                    expanded_scores = np.interp(np.linspace(0, len(lstm_scores)-1, dataset_size), 
+                                              np.arange(len(lstm_scores)), lstm_scores)
+                    expanded_anomalies = (expanded_scores > np.percentile(lstm_scores, 95)).astype(int)
+                
+                return {
+                    'scores': expanded_scores,
+                    'anomalies': expanded_anomalies,
+                    'weight': 0.3,
+                    'trained': lstm_trained,
+                    'model_version': lstm_entry['version'] if lstm_entry else None,
+                    'model_key': lstm_entry['key'] if lstm_entry else None
+                }
             except Exception as e:
                 print(f"Warning: LSTM model failed: {str(e)}")
         
+        members = [
+            (name, run_member) for name, run_member, enabled in [
+                ('isolation_forest', run_isolation_forest, 'isolation_forest' in model_types),
+                ('autoencoder', run_autoencoder, 'autoencoder' in model_types and dataset_size > 50),
+                ('lstm', run_lstm, 'lstm' in model_types and dataset_size > 100)
+            ] if enabled
+        ]
+        
+        for name, (details, timing) in run_ensemble_members(members).items():
+            if details is None:
+                continue
+            details.update(timing)
+            scores_list.append(details['scores'])
+            anomalies_list.append(details['anomalies'])
+            model_details[name] = details
+        
        
         if scores_list:
           
@@ -850,39 +1004,23 @@ def cluster_user_profiles(df, n_clusters=5):
     Returns cluster assignments and profile characteristics
     """
     try:
-        # Extract user behavior features
-        user_features = []
-        user_ids = []
+        # Extract user behavior features in one grouped pass
+        fraud_flags = (df['isFraud'] == 1) if 'isFraud' in df.columns else pd.Series(False, index=df.index)
+        grouped = df.assign(_fraud=fraud_flags.astype(np.int64)).groupby('nameOrig', observed=True, sort=False)
+        profiles = grouped.agg(
+            total_transactions=('amount', 'size'),
+            total_amount=('amount', 'sum'),
+            avg_amount=('amount', 'mean'),
+            std_amount=('amount', 'std'),
+            unique_recipients=('nameDest', 'nunique'),
+            days_active=('step', 'nunique'),
+            fraud_count=('_fraud', 'sum')
+        )
+        profiles['std_amount'] = profiles['std_amount'].fillna(0)
+        profiles['fraud_ratio'] = profiles['fraud_count'] / profiles['total_transactions']
         
-        for user_id in df['nameOrig'].unique():
-            user_data = df[df['nameOrig'] == user_id]
-            
-            # Calculate behavior metrics
-            total_transactions = len(user_data)
-            total_amount = user_data['amount'].sum()
-            avg_amount = user_data['amount'].mean() if len(user_data) > 0 else 0
-            std_amount = user_data['amount'].std() if len(user_data) > 1 else 0
-            
-            # Frequency metrics
-            unique_recipients = user_data['nameDest'].nunique()
-            days_active = user_data['step'].nunique()
-            
-            # Fraud involvement
-            fraud_transactions = user_data[user_data.get('isFraud', 0) == 1]
-            fraud_count = len(fraud_transactions)
-            fraud_ratio = fraud_count / total_transactions if total_transactions > 0 else 0
-            
-            user_ids.append(user_id)
-            user_features.append([
-                total_transactions,
-                total_amount,
-                avg_amount,
-                std_amount,
-                unique_recipients,
-                days_active,
-                fraud_count,
-                fraud_ratio
-            ])
+        user_ids = profiles.index.tolist()
+        user_features = profiles.astype(np.float64).values.tolist()
         
         if len(user_features) < n_clusters:
             n_clusters = max(1, len(user_features))
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+import os
+import time
+from sklearn.ensemble import IsolationForest
+from src.preprocessing import preprocess, CustomerHistory, REQUIRED_COLUMNS
+from src.data_processor import data_processor
+from src.resource_governor import resource_governor
+from src.feature_store import build_feature_matrix
+from src.quantile_sketch import QuantileSketch, quantile_sketch_store
+from src.rules import rule_engine
+from src.advanced_models import train_autoencoder_fast, autoencoder_anomaly_scores_fast
+
+EXCLUDE_COLS = ['step', 'type', 'nameOrig', 'nameDest', 'isFraud', 'isFlaggedFraud']
+
+def iter_source_chunks(source, chunk_size=100000, file_name=None):
+    """Yield validated raw row chunks from a CSV/Excel path or buffer, or an in-memory DataFrame"""
+    return data_processor.iter_chunks(source, chunk_size=chunk_size, file_name=file_name)
+
+def reservoir_sample(source, sample_size=50000, chunk_size=100000, random_state=42, file_name=None, amount_sketch=None,
+                     history=None):
+    """Uniform sample of rows collected in one pass with bounded memory; optionally sketches every amount on the way.
+    With a CustomerHistory the chunks are preprocessed in file order first, so the sampled rows carry the same
+    customer features a streaming scoring pass computes."""
+    rng = np.random.default_rng(random_state)
+    sample = None
+    total_rows = 0
+
+    for chunk in iter_source_chunks(source, chunk_size, file_name=file_name):
+        total_rows += len(chunk)
+        if amount_sketch is not None:
+            amount_sketch.update(pd.to_numeric(chunk['amount'], errors='coerce').to_numpy())
+        if history is not None:
+            chunk = preprocess(chunk, inplace=True, history=history)
+        chunk = chunk.assign(_sample_key=rng.random(len(chunk)))
+        if sample is not None:
+            chunk = pd.concat([sample, chunk], ignore_index=True)
+        sample = chunk.nsmallest(sample_size, '_sample_key') if len(chunk) > sample_size else chunk
+
+    if sample is None:
+        raise ValueError("Файл пустой. Проверьте содержимое файла.")
+    return sample.drop(columns='_sample_key').reset_index(drop=True), total_rows
+
+class ChunkedFraudScorer:
+
+    def __init__(self, model_types=['isolation_forest', 'autoencoder'], contamination=0.05,
+                 chunk_size=100000, sample_size=None, suspicious_percentile=95):
+        self.model_types = model_types
+        self.contamination = contamination
+        self.chunk_size = chunk_size
+        self.sample_size = sample_size or resource_governor.sample_size('reservoir')
+        self.suspicious_percentile = suspicious_percentile
+        self.models = {}
+        self.feature_cols = []
+        self.large_amount_threshold = None
+        self.score_range = (0.0, 1.0)
+        self.suspicious_threshold = None
+        self.history = CustomerHistory()
+        self.amount_sketch = None
+        self.score_sketch = QuantileSketch()
+        self.fitted = False
+
+    def _feature_matrix(self, df_processed):
+        return build_feature_matrix(df_processed, self.feature_cols)
+
+    def _ml_scores(self, X):
+        scores = []
+        weights = []
+        if 'isolation_forest' in self.models:
+            scores.append(-self.models['isolation_forest'].decision_function(X))
+            weights.append(0.4)
+        if 'autoencoder' in self.models:
+            scores.append(autoencoder_anomaly_scores_fast(self.models['autoencoder'], X))
+            weights.append(0.3)
+        return np.average(np.column_stack(scores), axis=1, weights=weights)
+
+    def fit(self, sample_df, amount_sketch=None, processed=False):
+        """Train on a sample; pass processed=True for rows already preprocessed in a streaming pass"""
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in sample_df.columns]
+        if missing_columns:
+            raise ValueError(f"Отсутствуют обязательные столбцы: {missing_columns}")
+
+        sample_processed = sample_df if processed else preprocess(sample_df, inplace=True)
+        self.feature_cols = [col for col in sample_processed.columns if col not in EXCLUDE_COLS]
+        X = self._feature_matrix(sample_processed)
+
+        self.models = {}
+        if 'autoencoder' in self.model_types and len(X) > 50:
+            self.models['autoencoder'] = train_autoencoder_fast(X, epochs=10 if len(X) > 1000 else 5)
+
+        if 'isolation_forest' in self.model_types or not self.models:
+            iso_forest = IsolationForest(contamination=self.contamination, random_state=42, n_estimators=100)
+            iso_forest.fit(X)
+            self.models['isolation_forest'] = iso_forest
+
+        self.amount_sketch = amount_sketch or QuantileSketch.from_values(sample_processed['amount'].to_numpy())
+        self.large_amount_threshold = self.amount_sketch.quantile(0.95)
+
+        ml_scores = self._ml_scores(X)
+        self.score_range = (float(np.min(ml_scores)), float(np.max(ml_scores)))
+        self.fitted = True
+
+        combined_scores = self._combine(ml_scores, sample_processed)
+        self.suspicious_threshold = QuantileSketch.from_values(combined_scores).quantile(self.suspicious_percentile / 100)
+        return self
+
+    def _combine(self, ml_scores, df_processed):
+        low, high = self.score_range
+        normalized_ml_scores = np.clip((ml_scores - low) / (high - low + 1e-8), 0, 1)
+        rules_combined, _ = rule_engine(df_processed, large_amount_threshold=self.large_amount_threshold)
+        return 0.7 * normalized_ml_scores + 0.3 * np.asarray(rules_combined)
+
+    def score_chunk(self, chunk):
+        if not self.fitted:
+            raise ValueError("Модель не обучена. Сначала вызовите fit().")
+
+        chunk_processed = preprocess(chunk, extend_vocabulary=False, history=self.history)
+        X = self._feature_matrix(chunk_processed)
+        combined_scores = self._combine(self._ml_scores(X), chunk_processed)
+        self.score_sketch.update(combined_scores)
+
+        result = chunk.copy()
+        result['fraud_score'] = combined_scores
+        result['is_suspicious'] = (combined_scores > self.suspicious_threshold).astype(np.int8)
+        return result
+
+    def score_to_file(self, source, output_path, progress_callback=None, file_name=None):
+        start_time = time.time()
+        sketch_key = None if isinstance(source, pd.DataFrame) else data_processor.get_file_hash(source)
+        stored_sketches = quantile_sketch_store.load(sketch_key) if sketch_key else {}
+
+        if not self.fitted:
+            amount_sketch = stored_sketches.get('amount')
+            full_amount_sketch = QuantileSketch() if amount_sketch is None else None
+            # customer features come from the whole file in order, as they will when scoring, not from the sample alone
+            sample_df, total_rows = reservoir_sample(source, self.sample_size, self.chunk_size, file_name=file_name,
+                                                     amount_sketch=full_amount_sketch, history=CustomerHistory())
+            self.fit(sample_df, amount_sketch=amount_sketch or full_amount_sketch, processed=True)
+            del sample_df
+        else:
+            total_rows = len(source) if isinstance(source, pd.DataFrame) else None
+
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        self.history = CustomerHistory()
+        self.score_sketch = QuantileSketch()
+        rows_scored = 0
+        suspicious_count = 0
+        score_sum = 0.0
+
+        for chunk_index, chunk in enumerate(iter_source_chunks(source, self.chunk_size, file_name=file_name)):
+            scored = self.score_chunk(chunk)
+            scored.to_csv(output_path, mode='w' if chunk_index == 0 else 'a',
+                          header=chunk_index == 0, index=False)
+
+            rows_scored += len(scored)
+            suspicious_count += int(scored['is_suspicious'].sum())
+            score_sum += float(scored['fraud_score'].sum())
+
+            if progress_callback is not None:
+                progress_callback(rows_scored, total_rows)
+
+        if sketch_key:
+            stored_sketches.update({'amount': self.amount_sketch, 'combined_score': self.score_sketch})
+            quantile_sketch_store.save(sketch_key, stored_sketches)
+
+        return {
+            'output_path': output_path,
+            'rows_scored': rows_scored,
+            'suspicious_count': suspicious_count,
+            'avg_fraud_score': score_sum / rows_scored if rows_scored else 0.0,
+            'suspicious_threshold': self.suspicious_threshold,
+            'execution_time': time.time() - start_time
+        }
+
+def score_all_rows(source, output_path, model_types=['isolation_forest', 'autoencoder'], contamination=0.05,
+                   chunk_size=100000, sample_size=None, progress_callback=None, file_name=None):
+    scorer = ChunkedFraudScorer(model_types=model_types, contamination=contamination,
+                                chunk_size=chunk_size, sample_size=sample_size)
+    return scorer.score_to_file(source, output_path, progress_callback=progress_callback, file_name=file_name)
@@ -1,16 +1,38 @@
 import pandas as pd
 import numpy as np
 import os
-import hashlib
 import json
 from datetime import datetime, timedelta
 import threading
 import time
+from src.preprocessing import (load_data, preprocess, apply_transaction_schema, is_schema_column, get_source_name,
+                               open_source, intern_account_ids, AccountVocabulary, CustomerHistory, REQUIRED_COLUMNS,
+                               LENIENT_READ_DTYPES)
+from src.rules import rule_engine
+from src.fingerprint import file_fingerprinter
+from src.resource_governor import resource_governor
+from src.quantile_sketch import QuantileSketch, quantile_sketch_store
+
+try:
+    import pyarrow
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+CACHE_FORMAT_VERSION = 7
 
 class DataProcessor:
     
-    def __init__(self, cache_dir="data_cache"):
+    def __init__(self, cache_dir="data_cache", max_cache_size_mb=2048, max_cache_age_hours=24 * 7,
+                 quick_hash_threshold_mb=None, min_chunk_size=1000, max_chunk_size=500000):
         self.cache_dir = cache_dir
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.ingest_stats = {}
+        self.ingest_lock = threading.Lock()
+        self.quick_hash_threshold_mb = quick_hash_threshold_mb
+        self.max_cache_size_mb = max_cache_size_mb
+        self.max_cache_age_hours = max_cache_age_hours
         self.processing_lock = threading.Lock()
         self.cache_metadata = {}
         
@@ -20,11 +42,36 @@ class DataProcessor:
         self.load_cache_metadata()
     
     def get_file_hash(self, file_path):
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        if not isinstance(file_path, (str, os.PathLike)):
+            return self.get_buffer_hash(file_path)
+        quick = (
+            self.quick_hash_threshold_mb is not None
+            and os.path.getsize(file_path) > self.quick_hash_threshold_mb * 1024 * 1024
+        )
+        return file_fingerprinter.fingerprint(file_path, quick=quick)
+    
+    def get_sources_hash(self, sources):
+        """One key for several sources analysed together, e.g. the files of a combined analysis"""
+        return self.combine_hashes([self.get_file_hash(source) for source in sources])
+    
+    def combine_hashes(self, file_hashes):
+        return file_fingerprinter.fingerprint_buffer("|".join(file_hashes).encode('utf-8'))
+    
+    def get_buffer_hash(self, source):
+        memo_key = getattr(source, 'file_id', None)
+        if hasattr(source, 'getbuffer'):
+            with source.getbuffer() as view:
+                return file_fingerprinter.fingerprint_buffer(view, memo_key=memo_key)
+        return file_fingerprinter.fingerprint_buffer(source, memo_key=memo_key)
+    
+    def get_source_size(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            return os.path.getsize(source)
+        if hasattr(source, 'getbuffer'):
+            with source.getbuffer() as view:
+                return view.nbytes
+        with memoryview(source) as view:
+            return view.nbytes
     
     def load_cache_metadata(self):
         metadata_file = os.path.join(self.cache_dir, "cache_metadata.json")
@@ -39,83 +86,263 @@ class DataProcessor:
     def save_cache_metadata(self):
         metadata_file = os.path.join(self.cache_dir, "cache_metadata.json")
         try:
-            with open(metadata_file, 'w') as f:
+            temp_file = f"{metadata_file}.{os.getpid()}.tmp"
+            with open(temp_file, 'w') as f:
                 json.dump(self.cache_metadata, f, indent=2)
+            os.replace(temp_file, metadata_file)
         except Exception as e:
             print(f"Ошибка при сохранении метаданных кэша: {str(e)}")
     
-    def is_cached(self, file_path):
-        file_hash = self.get_file_hash(file_path)
-        cache_file = os.path.join(self.cache_dir, f"{file_hash}.pkl")
+    def _get_cache_entry(self, file_hash):
+        entry = self.cache_metadata.get(file_hash)
+        if entry is None:
+            # another process (e.g. a file worker) may have cached it since the metadata was read
+            self.load_cache_metadata()
+            entry = self.cache_metadata.get(file_hash)
+        if not entry or entry.get('version') != CACHE_FORMAT_VERSION:
+            return None
+        
+        cache_file = os.path.join(self.cache_dir, entry.get('cache_file', ''))
+        if not os.path.isfile(cache_file):
+            return None
         
-        if os.path.exists(cache_file):
-            cache_time = os.path.getmtime(cache_file)
-            if datetime.now() - datetime.fromtimestamp(cache_time) < timedelta(hours=24):
-                return True
-        return False
+        cached_at = datetime.fromisoformat(entry['cached_at'])
+        if datetime.now() - cached_at > timedelta(hours=self.max_cache_age_hours):
+            return None
+        return entry
+    
+    def _cache_key(self, file_hash, kind):
+        return file_hash if kind == 'processed' else f"{file_hash}_{kind}"
     
-    def load_from_cache(self, file_path):
+    def is_cached(self, file_path, file_hash=None, kind='processed'):
         try:
-            file_hash = self.get_file_hash(file_path)
-            cache_file = os.path.join(self.cache_dir, f"{file_hash}.pkl")
-            
-            if os.path.exists(cache_file):
-                return None
-        except Exception as e:
-            print(f"Ошибка при загрузке из кэша: {str(e)}")
-        return None
+            file_hash = file_hash or self.get_file_hash(file_path)
+            return self._get_cache_entry(self._cache_key(file_hash, kind)) is not None
+        except Exception:
+            return False
     
-    def save_to_cache(self, file_path, processed_data):
+    def load_from_cache(self, file_path, file_hash=None, kind='processed'):
         try:
-            file_hash = self.get_file_hash(file_path)
-            cache_file = os.path.join(self.cache_dir, f"{file_hash}.pkl")
+            file_hash = file_hash or self.get_file_hash(file_path)
+            entry = self._get_cache_entry(self._cache_key(file_hash, kind))
+            if entry is None:
+                return None
             
-            self.cache_metadata[file_hash] = {
-                "original_file": file_path,
-                "cached_at": datetime.now().isoformat(),
-                "size": os.path.getsize(file_path)
-            }
+            cache_file = os.path.join(self.cache_dir, entry['cache_file'])
+            if entry.get('format') == 'parquet':
+                df = pd.read_parquet(cache_file)
+            else:
+                df = pd.read_pickle(cache_file)
             
+            entry['last_accessed'] = datetime.now().isoformat()
             self.save_cache_metadata()
-            return True
+            return intern_account_ids(df)
         except Exception as e:
-            print(f"Ошибка при сохранении в кэш: {str(e)}")
-            return False
+            print(f"Ошибка при загрузке из кэша: {str(e)}")
+        return None
     
-    def process_large_file(self, file_path, chunk_size=10000):
+    def save_to_cache(self, file_path, processed_data, file_hash=None, file_name=None, kind='processed'):
         try:
-            file_extension = os.path.splitext(file_path)[1].lower()
+            file_hash = file_hash or self.get_file_hash(file_path)
+            cache_key = self._cache_key(file_hash, kind)
             
-            if file_extension == '.csv':
-                chunks = []
-                chunk_count = 0
-                
-                for chunk in pd.read_csv(file_path, chunksize=chunk_size):
-                    chunks.append(chunk)
-                    chunk_count += 1
-                    
-                    if chunk_count > 100:
-                        break
+            with self.processing_lock:
+                cache_format = None
+                if PYARROW_AVAILABLE:
+                    cache_file = f"{cache_key}.parquet"
+                    try:
+                        processed_data.to_parquet(os.path.join(self.cache_dir, cache_file), index=False)
+                        cache_format = 'parquet'
+                    except Exception:
+                        cache_format = None
                 
-                if chunks:
-                    return pd.concat(chunks, ignore_index=True)
-                    
-            elif file_extension == '.xlsx':
-                xl_file = pd.ExcelFile(file_path)
-                sheets = []
+                if cache_format is None:
+                    cache_file = f"{cache_key}.pkl"
+                    processed_data.reset_index(drop=True).to_pickle(os.path.join(self.cache_dir, cache_file))
+                    cache_format = 'pickle'
                 
-                for sheet_name in xl_file.sheet_names[:5]:
-                    df = xl_file.parse(sheet_name)
-                    sheets.append(df)
+                self.load_cache_metadata()
+                now = datetime.now().isoformat()
+                self.cache_metadata[cache_key] = {
+                    "original_file": get_source_name(file_path, file_name),
+                    "cached_at": now,
+                    "last_accessed": now,
+                    "size": self.get_source_size(file_path),
+                    "cache_file": cache_file,
+                    "cache_size": os.path.getsize(os.path.join(self.cache_dir, cache_file)),
+                    "format": cache_format,
+                    "rows": int(len(processed_data)),
+                    "kind": kind,
+                    "version": CACHE_FORMAT_VERSION
+                }
                 
-                if sheets:
-                    return pd.concat(sheets, ignore_index=True)
-            
-            return pd.read_csv(file_path) if file_extension == '.csv' else pd.read_excel(file_path)
-            
+                self.evict_cache()
+                self.save_cache_metadata()
+            return True
         except Exception as e:
-            print(f"Ошибка при обработке большого файла: {str(e)}")
-            return None
+            print(f"Ошибка при сохранении в кэш: {str(e)}")
+            return False
+    
+    def evict_cache(self):
+        max_age = timedelta(hours=self.max_cache_age_hours)
+        now = datetime.now()
+        
+        for file_hash, entry in list(self.cache_metadata.items()):
+            cache_file = os.path.join(self.cache_dir, entry.get('cache_file', ''))
+            expired = (
+                entry.get('version') != CACHE_FORMAT_VERSION
+                or not os.path.isfile(cache_file)
+                or now - datetime.fromisoformat(entry['cached_at']) > max_age
+            )
+            if expired:
+                self._remove_cache_entry(file_hash)
+        
+        max_bytes = self.max_cache_size_mb * 1024 * 1024
+        entries = sorted(self.cache_metadata.items(), key=lambda item: item[1].get('last_accessed', item[1]['cached_at']))
+        total_bytes = sum(entry.get('cache_size', 0) for _, entry in entries)
+        
+        for file_hash, entry in entries[:-1]:
+            if total_bytes <= max_bytes:
+                break
+            total_bytes -= entry.get('cache_size', 0)
+            self._remove_cache_entry(file_hash)
+    
+    def _remove_cache_entry(self, file_hash):
+        entry = self.cache_metadata.pop(file_hash, {})
+        cache_file = os.path.join(self.cache_dir, entry.get('cache_file', ''))
+        if entry.get('cache_file') and os.path.isfile(cache_file):
+            try:
+                os.remove(cache_file)
+            except OSError as e:
+                print(f"Ошибка при удалении файла кэша: {str(e)}")
+    
+    def load_excel_sidecar(self, file_path, file_name=None, file_hash=None):
+        file_hash = file_hash or self.get_file_hash(file_path)
+        sidecar = self.load_from_cache(file_path, file_hash=file_hash, kind='xlsx')
+        if sidecar is not None:
+            return sidecar
+        
+        df = load_data(file_path, file_name=file_name)
+        self.save_to_cache(file_path, df, file_hash=file_hash, file_name=file_name, kind='xlsx')
+        return df
+    
+    def load_raw(self, file_path, file_name=None, file_hash=None):
+        if get_source_name(file_path, file_name).lower().endswith('.xlsx'):
+            return self.load_excel_sidecar(file_path, file_name=file_name, file_hash=file_hash)
+        return load_data(file_path, file_name=file_name)
+    
+    def load_and_preprocess(self, file_path, file_name=None, file_hash=None):
+        file_hash = file_hash or self.get_file_hash(file_path)
+        cached = self.load_from_cache(file_path, file_hash=file_hash)
+        if cached is not None:
+            return cached, True
+        
+        df_processed = preprocess(self.load_raw(file_path, file_name=file_name, file_hash=file_hash), inplace=True)
+        self.save_to_cache(file_path, df_processed, file_hash=file_hash, file_name=file_name)
+        return df_processed, False
+    
+    def _reset_ingest_stats(self, chunk_size):
+        with self.ingest_lock:
+            self.ingest_stats = {
+                "rows": 0,
+                "chunks": 0,
+                "elapsed": 0.0,
+                "rows_per_sec": 0.0,
+                "chunk_size": chunk_size,
+                "started_at": time.time()
+            }
+    
+    def _record_chunk(self, chunk_rows, chunk_size):
+        with self.ingest_lock:
+            stats = self.ingest_stats
+            stats["rows"] += chunk_rows
+            stats["chunks"] += 1
+            stats["elapsed"] = time.time() - stats["started_at"]
+            stats["rows_per_sec"] = stats["rows"] / stats["elapsed"] if stats["elapsed"] > 0 else 0.0
+            stats["chunk_size"] = chunk_size
+    
+    def get_ingest_stats(self):
+        with self.ingest_lock:
+            return dict(self.ingest_stats)
+    
+    def adapt_chunk_size(self, chunk_size):
+        return resource_governor.chunk_size(chunk_size, self.min_chunk_size, self.max_chunk_size)
+    
+    def validate_chunk(self, chunk, vocabulary=None):
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+        if missing_columns:
+            raise ValueError(f"Отсутствуют обязательные столбцы: {missing_columns}")
+        
+        return apply_transaction_schema(chunk.copy(), vocabulary=vocabulary)
+    
+    def iter_chunks(self, source, chunk_size=10000, file_name=None):
+        file_extension = None if isinstance(source, pd.DataFrame) else os.path.splitext(get_source_name(source, file_name))[1].lower()
+        self._reset_ingest_stats(chunk_size)
+        vocabulary = AccountVocabulary()
+        
+        if isinstance(source, pd.DataFrame):
+            start = 0
+            while start < len(source):
+                chunk = self.validate_chunk(source.iloc[start:start + chunk_size], vocabulary)
+                start += len(chunk)
+                self._record_chunk(len(chunk), chunk_size)
+                yield chunk
+                chunk_size = self.adapt_chunk_size(chunk_size)
+        
+        elif file_extension == '.csv':
+            with pd.read_csv(open_source(source), chunksize=chunk_size, usecols=is_schema_column,
+                             dtype=LENIENT_READ_DTYPES, low_memory=False) as reader:
+                while True:
+                    try:
+                        chunk = reader.get_chunk(chunk_size)
+                    except StopIteration:
+                        break
+                    chunk = self.validate_chunk(chunk, vocabulary)
+                    self._record_chunk(len(chunk), chunk_size)
+                    yield chunk
+                    chunk_size = self.adapt_chunk_size(chunk_size)
+        
+        elif file_extension == '.xlsx':
+            workbook = self.load_excel_sidecar(source, file_name=file_name)
+            for start in range(0, len(workbook), chunk_size):
+                chunk = self.validate_chunk(workbook.iloc[start:start + chunk_size], vocabulary)
+                self._record_chunk(len(chunk), chunk_size)
+                yield chunk
+        
+        else:
+            raise ValueError("Неподдерживаемый формат файла. Используйте CSV или Excel файлы.")
+    
+    def sketch_amounts(self, source, chunk_size=100000, file_name=None):
+        """Quantile sketch of every amount in a source, reading only the amount column where the format allows"""
+        amount_sketch = QuantileSketch()
+        file_extension = None if isinstance(source, pd.DataFrame) else os.path.splitext(get_source_name(source, file_name))[1].lower()
+        if file_extension == '.csv':
+            with pd.read_csv(open_source(source), chunksize=chunk_size, usecols=['amount']) as reader:
+                for chunk in reader:
+                    amount_sketch.update(pd.to_numeric(chunk['amount'], errors='coerce').to_numpy())
+        else:
+            for chunk in self.iter_chunks(source, chunk_size=chunk_size, file_name=file_name):
+                amount_sketch.update(chunk['amount'].to_numpy())
+        return amount_sketch
+    
+    def process_large_file(self, file_path, chunk_size=10000, large_amount_threshold=None):
+        """Without an explicit threshold, every chunk uses the file's 95th amount percentile, from the stored
+        sketch or a pre-pass over the amount column"""
+        history = CustomerHistory()
+        if large_amount_threshold is None:
+            file_hash = self.get_file_hash(file_path)
+            sketches = quantile_sketch_store.load(file_hash)
+            if 'amount' not in sketches:
+                sketches['amount'] = self.sketch_amounts(file_path)
+                quantile_sketch_store.save(file_hash, sketches)
+            large_amount_threshold = sketches['amount'].quantile(0.95)
+
+        for chunk in self.iter_chunks(file_path, chunk_size=chunk_size):
+            if chunk.empty:
+                continue
+            chunk_processed = preprocess(chunk, inplace=True, history=history)
+            rules_combined, rules_mask = rule_engine(chunk_processed, large_amount_threshold=large_amount_threshold)
+            yield chunk_processed, rules_combined, rules_mask
     
     def get_file_preview(self, file_path, preview_rows=100):
         try:
@@ -124,6 +351,8 @@ class DataProcessor:
             if file_extension == '.csv':
                 return pd.read_csv(file_path, nrows=preview_rows)
             elif file_extension == '.xlsx':
+                if self.is_cached(file_path, kind='xlsx'):
+                    return self.load_from_cache(file_path, kind='xlsx').head(preview_rows)
                 xl_file = pd.ExcelFile(file_path)
                 first_sheet = xl_file.sheet_names[0]
                 return xl_file.parse(first_sheet, nrows=preview_rows)
@@ -132,16 +361,6 @@ class DataProcessor:
             return None
     
     def monitor_memory_usage(self):
-        try:
-            import psutil
-            process = psutil.Process(os.getpid())
-            memory_info = process.memory_info()
-            return {
-                "rss": memory_info.rss / 1024 / 1024,
-                "vms": memory_info.vms / 1024 / 1024,
-                "percent": process.memory_percent()
-            }
-        except:
-            return {"rss": 0, "vms": 0, "percent": 0}
+        return resource_governor.memory_usage()
 
 data_processor = DataProcessor()
\ No newline at end of file
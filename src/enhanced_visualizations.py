@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
+from src.feature_store import FeatureStore, get_feature_columns
 
 try:
     import plotly.graph_objects as go
@@ -94,33 +95,25 @@ class EnhancedVisualizations:
             print(f"Error creating performance dashboard: {str(e)}")
             return None
     
-    def create_feature_importance_analysis(self, df, model_details, top_n=15):
+    def create_feature_importance_analysis(self, df, model_details, top_n=15, feature_store=None):
         if not PLOTLY_AVAILABLE:
             print("Plotly not available. Skipping feature importance analysis.")
             return None
             
         try:
-            exclude_cols = ['step', 'type', 'nameOrig', 'nameDest', 'isFraud', 'isFlaggedFraud']
-            feature_cols = [col for col in df.columns if col not in exclude_cols]
+            if feature_store is None:
+                feature_cols = get_feature_columns(df)
+                if len(feature_cols) == 0:
+                    return None
+                feature_store = FeatureStore.from_frame(df, feature_cols)
             
-            if len(feature_cols) == 0:
-                return None
+            correlations = []
+            for model_name, detail in model_details.items():
+                if 'scores' in detail and len(detail['scores']) > 1:
+                    correlations.append(feature_store.score_correlations(detail['scores']))
             
-            feature_importance = {}
-            
-            for col in feature_cols:
-                values = pd.to_numeric(df[col], errors='coerce').fillna(0)
-                
-                correlations = []
-                for model_name, detail in model_details.items():
-                    if 'scores' in detail:
-                        scores = detail['scores'][:len(values)]
-                        if len(scores) > 1 and len(values) > 1:
-                            corr = abs(np.corrcoef(values[:len(scores)], scores)[0, 1])
-                            correlations.append(corr if not np.isnan(corr) else 0)
-                
-                avg_corr = np.mean(correlations) if correlations else 0
-                feature_importance[col] = avg_corr
+            avg_corr = np.mean(correlations, axis=0) if correlations else np.zeros(len(feature_store.columns))
+            feature_importance = dict(zip(feature_store.columns, avg_corr))
             
             sorted_features = sorted(feature_importance.items(), key=lambda x: x[1], reverse=True)[:top_n]
             features, importances = zip(*sorted_features)
@@ -143,65 +136,55 @@ class EnhancedVisualizations:
             print(f"Error creating feature importance analysis: {str(e)}")
             return None
     
-    def create_anomaly_cluster_visualization(self, df, combined_scores, is_suspicious, n_components=2):
+    def _anomaly_cluster_figure(self, X_reduced, is_suspicious):
+        fig = go.Figure()
+        
+        normal_points = X_reduced[~is_suspicious.astype(bool)]
+        suspicious_points = X_reduced[is_suspicious.astype(bool)]
+        
+        if len(normal_points) > 0:
+            fig.add_trace(go.Scatter(
+                x=normal_points[:, 0],
+                y=normal_points[:, 1] if normal_points.shape[1] > 1 else np.zeros(len(normal_points)),
+                mode='markers',
+                marker=dict(color='blue', size=6, opacity=0.6),
+                name='Нормальные транзакции'
+            ))
+        
+        if len(suspicious_points) > 0:
+            fig.add_trace(go.Scatter(
+                x=suspicious_points[:, 0],
+                y=suspicious_points[:, 1] if suspicious_points.shape[1] > 1 else np.zeros(len(suspicious_points)),
+                mode='markers',
+                marker=dict(color='red', size=8, opacity=0.8),
+                name='Подозрительные транзакции'
+            ))
+        
+        fig.update_layout(
+            title="Визуализация кластеров аномалий (PCA)",
+            xaxis_title="PC1",
+            yaxis_title="PC2",
+            height=600
+        )
+        
+        return fig
+    
+    def create_anomaly_cluster_visualization(self, df, combined_scores, is_suspicious, n_components=2, feature_store=None):
         if not PLOTLY_AVAILABLE:
             print("Plotly not available. Skipping anomaly cluster visualization.")
             return None
             
         try:
-            exclude_cols = ['step', 'type', 'nameOrig', 'nameDest', 'isFraud', 'isFlaggedFraud']
-            feature_cols = [col for col in df.columns if col not in exclude_cols]
-            
-            if len(feature_cols) == 0:
-                return None
-            
-            X_df = df[feature_cols].copy()
-            for col in X_df.columns:
-                X_df[col] = pd.to_numeric(X_df[col], errors='coerce')
-            
-            X_df = X_df.fillna(0)
-            X = X_df.values
+            if feature_store is None:
+                feature_cols = get_feature_columns(df)
+                if len(feature_cols) == 0:
+                    return None
+                feature_store = FeatureStore.from_frame(df, feature_cols)
             
-            if X.shape[0] < 2:
+            if len(feature_store) < 2:
                 return None
             
-            if X.shape[1] > n_components:
-                pca = PCA(n_components=min(n_components, X.shape[1]))
-                X_reduced = pca.fit_transform(X)
-            else:
-                X_reduced = X[:, :n_components]
-            
-            fig = go.Figure()
-            
-            normal_points = X_reduced[~is_suspicious.astype(bool)]
-            suspicious_points = X_reduced[is_suspicious.astype(bool)]
-            
-            if len(normal_points) > 0:
-                fig.add_trace(go.Scatter(
-                    x=normal_points[:, 0],
-                    y=normal_points[:, 1] if normal_points.shape[1] > 1 else np.zeros(len(normal_points)),
-                    mode='markers',
-                    marker=dict(color='blue', size=6, opacity=0.6),
-                    name='Нормальные транзакции'
-                ))
-            
-            if len(suspicious_points) > 0:
-                fig.add_trace(go.Scatter(
-                    x=suspicious_points[:, 0],
-                    y=suspicious_points[:, 1] if suspicious_points.shape[1] > 1 else np.zeros(len(suspicious_points)),
-                    mode='markers',
-                    marker=dict(color='red', size=8, opacity=0.8),
-                    name='Подозрительные транзакции'
-                ))
-            
-            fig.update_layout(
-                title="Визуализация кластеров аномалий (PCA)",
-                xaxis_title="PC1",
-                yaxis_title="PC2",
-                height=600
-            )
-            
-            return fig
+            return self._anomaly_cluster_figure(feature_store.pca_projection(n_components), is_suspicious)
             
         except Exception as e:
             print(f"Error creating anomaly cluster visualization: {str(e)}")
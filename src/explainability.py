@@ -2,9 +2,19 @@ import shap
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from src.rules import compiled_rules
 import warnings
 warnings.filterwarnings('ignore')
 
+SUMMARY_LABELS = {
+    'rule_large_amount': "большая сумма",
+    'rule_new_destination': "новый получатель",
+    'rule_balance_depletion': "опустошение счета",
+    'rule_unusual_time': "необычное время",
+    'rule_velocity_spike': "высокая активность",
+    'rule_round_amount': "круглая сумма"
+}
+
 def calculate_shap_values(model, X, feature_names=None):
     try:
         if feature_names is None:
@@ -53,32 +63,10 @@ def generate_explanation_text(shap_values, feature_names, instance_idx=0):
     except Exception as e:
         return f"Не удалось сгенерировать объяснение: {str(e)}"
 
-def aggregate_explanations(rules_flags, shap_values=None, feature_names=None):
+def aggregate_explanations(rules_mask, shap_values=None, feature_names=None, rows=None):
     try:
-        explanations = []
-        
-        for idx, row in rules_flags.iterrows():
-            triggered_rules = []
-            if row['rule_large_amount']:
-                triggered_rules.append("большая сумма")
-            if row['rule_new_destination']:
-                triggered_rules.append("новый получатель")
-            if row['rule_balance_depletion']:
-                triggered_rules.append("опустошение счета")
-            if row['rule_unusual_time']:
-                triggered_rules.append("необычное время")
-            if row['rule_velocity_spike']:
-                triggered_rules.append("высокая активность")
-            if row['rule_round_amount']:
-                triggered_rules.append("круглая сумма")
-            
-            if triggered_rules:
-                explanation = "Подозрительно из-за: " + ", ".join(triggered_rules)
-            else:
-                explanation = "Нет подозрительных признаков"
-            
-            explanations.append(explanation)
-        
-        return explanations
+        labels = [SUMMARY_LABELS.get(name, label) for name, label in zip(compiled_rules.names, compiled_rules.labels())]
+        return compiled_rules.explain(rules_mask, rows=rows, labels=labels)
     except Exception as e:
-        return [f"Ошибка генерации объяснений: {str(e)}"] * len(rules_flags)
+        n_rows = len(rules_mask) if rows is None else len(rows)
+        return [f"Ошибка генерации объяснений: {str(e)}"] * n_rows
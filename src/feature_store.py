@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+import os
+import json
+import uuid
+import threading
+from sklearn.decomposition import IncrementalPCA
+from src.data_processor import CACHE_FORMAT_VERSION
+
+EXCLUDE_COLS = ['step', 'type', 'nameOrig', 'nameDest', 'isFraud', 'isFlaggedFraud']
+
+def get_feature_columns(df):
+    return [col for col in df.columns if col not in EXCLUDE_COLS]
+
+def build_feature_matrix(df, feature_cols=None, out=None):
+    """Fill a C-contiguous float32 matrix column by column, coercing and cleaning each column once"""
+    feature_cols = feature_cols or get_feature_columns(df)
+    if out is None:
+        out = np.empty((len(df), len(feature_cols)), dtype=np.float32, order='C')
+    
+    for j, col in enumerate(feature_cols):
+        if col not in df.columns:
+            out[:, j] = 0.0
+            continue
+        series = df[col]
+        if not pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            series = pd.to_numeric(series, errors='coerce')
+        out[:, j] = series.to_numpy(dtype=np.float32, na_value=np.nan)
+    
+    np.nan_to_num(out, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    return out
+
+def iter_row_slices(matrix, batch_rows=100000):
+    """Yield (start, view) pairs over a matrix without copying it"""
+    for start in range(0, matrix.shape[0], batch_rows):
+        yield start, matrix[start:start + batch_rows]
+
+def is_constant_matrix(matrix, batch_rows=100000):
+    """True when every row equals the first, checked slice by slice"""
+    if matrix.shape[0] == 0:
+        return False
+    first_row = np.asarray(matrix[0])
+    for _, block in iter_row_slices(matrix, batch_rows):
+        if not np.all(block == first_row):
+            return False
+    return True
+
+class FeatureStore:
+    """Feature matrix of one analysed dataset, handed out as views with lazily memoized derived matrices"""
+
+    def __init__(self, matrix, columns, index=None, batch_rows=100000):
+        self.matrix = matrix
+        self.columns = list(columns)
+        self.index = index if index is not None else pd.RangeIndex(matrix.shape[0])
+        self.batch_rows = batch_rows
+        self.derived_views = {}
+
+    @classmethod
+    def from_frame(cls, df, feature_cols=None):
+        feature_cols = feature_cols or get_feature_columns(df)
+        return cls(build_feature_matrix(df, feature_cols), feature_cols, index=df.index)
+
+    @classmethod
+    def from_key(cls, key, index=None):
+        matrix, columns = feature_matrix_store.open(key)
+        return cls(matrix, columns, index=index)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def _memoized(self, key, compute):
+        if key not in self.derived_views:
+            self.derived_views[key] = compute()
+        return self.derived_views[key]
+
+    def column_positions(self, columns):
+        return [self.columns.index(col) for col in columns]
+
+    def row_positions(self, labels):
+        """Map DataFrame index labels (or a boolean mask) to matrix row positions"""
+        labels = np.asarray(labels)
+        if labels.dtype == bool:
+            return np.flatnonzero(labels)
+        return self.index.get_indexer(labels)
+
+    def select(self, columns=None, rows=None):
+        """Raw matrix restricted to the given rows/columns; columns the store lacks read as zeros"""
+        matrix = self.matrix
+        if rows is not None:
+            matrix = matrix[self.row_positions(rows)]
+        if columns is not None:
+            present = [col for col in columns if col in self.columns]
+            if len(present) == len(columns):
+                return matrix[:, self.column_positions(columns)]
+            selected = np.zeros((matrix.shape[0], len(columns)), dtype=np.float32)
+            for j, col in enumerate(columns):
+                if col in self.columns:
+                    selected[:, j] = matrix[:, self.columns.index(col)]
+            return selected
+        return matrix
+
+    def column_stats(self):
+        def compute():
+            total = np.zeros(self.matrix.shape[1])
+            total_sq = np.zeros(self.matrix.shape[1])
+            for _, block in iter_row_slices(self.matrix, self.batch_rows):
+                block = block.astype(np.float64)
+                total += block.sum(axis=0)
+                total_sq += (block ** 2).sum(axis=0)
+            n_rows = max(len(self), 1)
+            mean = total / n_rows
+            std = np.sqrt(np.maximum(total_sq / n_rows - mean ** 2, 0))
+            return mean.astype(np.float32), std.astype(np.float32)
+        return self._memoized('column_stats', compute)
+
+    def standardized(self, columns=None, rows=None):
+        """Z-scored copy of a row/column selection; statistics come from the selected rows"""
+        selected = np.asarray(self.select(columns, rows), dtype=np.float64)
+        return (selected - selected.mean(axis=0)) / (selected.std(axis=0) + 1e-8)
+
+    def score_correlations(self, scores):
+        """Absolute correlation of each column with a score vector over the leading rows: the z-scored X.T @ scores,
+        accumulated slice by slice from the raw matrix and column_stats()"""
+        scores = np.asarray(scores, dtype=np.float64)[:len(self)]
+        scores = (scores - scores.mean()) / (scores.std() + 1e-8)
+        mean, std = self.column_stats()
+        product = np.zeros(self.matrix.shape[1])
+        for start, block in iter_row_slices(self.matrix[:len(scores)], self.batch_rows):
+            product += block.astype(np.float64).T @ scores[start:start + len(block)]
+        product -= mean * scores.sum()
+        return np.abs(product / (std + 1e-8)) / len(scores)
+
+    def pca_projection(self, n_components=2):
+        """Raw matrix projected with PCA fitted slice by slice"""
+        def compute():
+            if self.matrix.shape[1] <= n_components:
+                return np.asarray(self.matrix[:, :n_components])
+            
+            pca = IncrementalPCA(n_components=n_components)
+            batch_rows = max(self.batch_rows, n_components)
+            for _, block in iter_row_slices(self.matrix, batch_rows):
+                if len(block) >= n_components:
+                    pca.partial_fit(block)
+            
+            projection = np.empty((len(self), n_components), dtype=np.float32)
+            for start, block in iter_row_slices(self.matrix, batch_rows):
+                projection[start:start + len(block)] = pca.transform(block)
+            return projection
+        return self._memoized(('pca', n_components), compute)
+
+class FeatureMatrixStore:
+
+    def __init__(self, store_dir="feature_store", max_store_size_mb=4096, write_batch_rows=100000):
+        self.store_dir = store_dir
+        self.max_store_size_mb = max_store_size_mb
+        self.write_batch_rows = write_batch_rows
+        self.store_lock = threading.Lock()
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def _paths(self, key):
+        base = os.path.join(self.store_dir, key)
+        return f"{base}.npy", f"{base}.json"
+
+    def exists(self, key):
+        matrix_path, meta_path = self._paths(key)
+        return os.path.isfile(matrix_path) and os.path.isfile(meta_path)
+
+    def write(self, df, key=None, feature_cols=None):
+        """Write the numeric feature matrix of df to a float32 .npy once, in row batches"""
+        key = key or uuid.uuid4().hex
+        feature_cols = feature_cols or get_feature_columns(df)
+        if len(feature_cols) == 0:
+            raise ValueError("Нет допустимых признаков для анализа. Проверьте, что файл содержит числовые данные.")
+
+        matrix_path, meta_path = self._paths(key)
+        temp_path = f"{matrix_path}.{os.getpid()}.tmp.npy"
+
+        matrix = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=(len(df), len(feature_cols)))
+        for start in range(0, len(df), self.write_batch_rows):
+            block = df.iloc[start:start + self.write_batch_rows]
+            build_feature_matrix(block, feature_cols, out=matrix[start:start + len(block)])
+        matrix.flush()
+        del matrix
+
+        with self.store_lock:
+            os.replace(temp_path, matrix_path)
+            with open(meta_path, 'w') as f:
+                json.dump({'columns': feature_cols, 'rows': len(df), 'version': CACHE_FORMAT_VERSION}, f)
+            self.evict(keep=key)
+
+        return key
+
+    def open(self, key):
+        """Read-only memory-mapped view of a stored matrix and its column names"""
+        matrix_path, _ = self._paths(key)
+        meta = self.read_meta(key)
+        os.utime(matrix_path)
+        return np.load(matrix_path, mmap_mode='r'), meta['columns']
+
+    def read_meta(self, key):
+        _, meta_path = self._paths(key)
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    def get_or_write(self, df, key):
+        """Reuse a stored matrix only if it was written by the current preprocessing for the same columns and rows"""
+        feature_cols = get_feature_columns(df)
+        if self.exists(key):
+            try:
+                meta = self.read_meta(key)
+                if (meta.get('version') == CACHE_FORMAT_VERSION and meta.get('columns') == feature_cols
+                        and meta.get('rows') == len(df)):
+                    return self.open(key)
+            except Exception as e:
+                print(f"Warning: Could not read feature matrix metadata: {str(e)}")
+        self.write(df, key=key, feature_cols=feature_cols)
+        return self.open(key)
+
+    def remove(self, key):
+        for path in self._paths(key):
+            if os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Warning: Could not remove feature matrix file: {str(e)}")
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.store_dir):
+            if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+                path = os.path.join(self.store_dir, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), name[:-len('.npy')]))
+
+        max_bytes = self.max_store_size_mb * 1024 * 1024
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_bytes -= size
+
+feature_matrix_store = FeatureMatrixStore()
@@ -0,0 +1,95 @@
+import hashlib
+import mmap
+import os
+import threading
+
+class FileFingerprinter:
+
+    def __init__(self, buffer_size=8 * 1024 * 1024, quick_sample_size=4 * 1024 * 1024, digest_size=20, max_memo_entries=256):
+        self.buffer_size = buffer_size
+        self.quick_sample_size = quick_sample_size
+        self.digest_size = digest_size
+        self.max_memo_entries = max_memo_entries
+        self.memo = {}
+        self.memo_lock = threading.Lock()
+
+    def _stat_key(self, file_path, quick):
+        stat = os.stat(file_path)
+        return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, quick)
+
+    def fingerprint(self, file_path, quick=False):
+        """Content fingerprint of a file, memoized by (path, size, mtime_ns)"""
+        key = self._stat_key(file_path, quick)
+        with self.memo_lock:
+            cached = self.memo.get(key)
+        if cached is not None:
+            return cached
+
+        if quick:
+            digest = self._quick_digest(file_path, key[1])
+        else:
+            digest = self._full_digest(file_path, key[1])
+
+        self._remember(key, digest)
+        return digest
+
+    def fingerprint_buffer(self, data, memo_key=None):
+        """Fingerprint of in-memory bytes without copying them"""
+        with memoryview(data) as view:
+            key = ('buffer', memo_key, view.nbytes) if memo_key is not None else None
+            if key is not None:
+                with self.memo_lock:
+                    cached = self.memo.get(key)
+                if cached is not None:
+                    return cached
+
+            hasher = hashlib.blake2b(digest_size=self.digest_size)
+            flat = view.cast('B') if view.ndim != 1 or view.format != 'B' else view
+            for offset in range(0, view.nbytes, self.buffer_size):
+                hasher.update(flat[offset:offset + self.buffer_size])
+            digest = hasher.hexdigest()
+
+        if key is not None:
+            self._remember(key, digest)
+        return digest
+
+    def _remember(self, key, digest):
+        with self.memo_lock:
+            if len(self.memo) >= self.max_memo_entries:
+                self.memo.pop(next(iter(self.memo)))
+            self.memo[key] = digest
+
+    def quick_fingerprint(self, file_path):
+        """Fingerprint from head, tail and size only, for huge files"""
+        return self.fingerprint(file_path, quick=True)
+
+    def _full_digest(self, file_path, file_size):
+        hasher = hashlib.blake2b(digest_size=self.digest_size)
+        with open(file_path, "rb") as f:
+            if file_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, file_size, self.buffer_size):
+                            hasher.update(view[offset:offset + self.buffer_size])
+                    finally:
+                        view.release()
+        return hasher.hexdigest()
+
+    def _quick_digest(self, file_path, file_size):
+        if file_size <= 2 * self.quick_sample_size:
+            return "q" + self._full_digest(file_path, file_size)
+
+        hasher = hashlib.blake2b(digest_size=self.digest_size)
+        hasher.update(str(file_size).encode())
+        with open(file_path, "rb") as f:
+            hasher.update(f.read(self.quick_sample_size))
+            f.seek(file_size - self.quick_sample_size)
+            hasher.update(f.read(self.quick_sample_size))
+        return "q" + hasher.hexdigest()
+
+    def clear(self):
+        with self.memo_lock:
+            self.memo.clear()
+
+file_fingerprinter = FileFingerprinter()
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+import joblib
+import sklearn
+import torch
+
+REGISTRY_FORMAT_VERSION = 1
+# a model only becomes reusable for other datasets once it was trained on at least this many rows
+MIN_REFERENCE_TRAINING_ROWS = 1000
+
+def schema_hash(columns):
+    """Hash of the ordered feature columns a model was trained on"""
+    return hashlib.blake2b(json.dumps(list(columns)).encode('utf-8'), digest_size=10).hexdigest()
+
+def params_hash(params):
+    return hashlib.blake2b(json.dumps(params, sort_keys=True, default=str).encode('utf-8'), digest_size=10).hexdigest()
+
+class ModelRegistry:
+    """Fitted estimators and torch state_dicts on disk, keyed by model type, feature schema, parameters
+    and training-data fingerprint, with per-lineage versions, LRU eviction and an in-process warm cache"""
+
+    def __init__(self, registry_dir="models/registry", max_registry_size_mb=512, max_loaded_models=8):
+        self.registry_dir = registry_dir
+        self.max_registry_size_mb = max_registry_size_mb
+        self.max_loaded_models = max_loaded_models
+        self.manifest_path = os.path.join(registry_dir, "manifest.json")
+        self.loaded_models = OrderedDict()
+        self.registry_lock = threading.Lock()
+
+        if not os.path.exists(registry_dir):
+            os.makedirs(registry_dir)
+
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Warning: Could not load model registry manifest: {str(e)}")
+        return {}
+
+    def save_manifest(self):
+        try:
+            temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+            os.replace(temp_path, self.manifest_path)
+        except Exception as e:
+            print(f"Warning: Could not save model registry manifest: {str(e)}")
+
+    def _lineage(self, model_type, feature_schema, params):
+        return f"{model_type}:{feature_schema}:{params_hash(params)}"
+
+    def _library_versions(self):
+        return {'sklearn': sklearn.__version__, 'torch': torch.__version__}
+
+    def _artifact_path(self, key):
+        return os.path.join(self.registry_dir, f"{key}.joblib")
+
+    def _is_loadable(self, entry):
+        return (entry.get('format') == REGISTRY_FORMAT_VERSION
+                and entry.get('libraries') == self._library_versions()
+                and os.path.isfile(self._artifact_path(entry['key'])))
+
+    def find(self, model_type, feature_schema, params, data_fingerprint=None):
+        """Manifest entry trained on exactly this data, else the latest version of the lineage promoted as a reference model"""
+        lineage = self._lineage(model_type, feature_schema, params)
+        with self.registry_lock:
+            self.manifest.update(self.load_manifest())
+            candidates = [entry for entry in self.manifest.values()
+                          if entry['lineage'] == lineage and self._is_loadable(entry)]
+        exact = [entry for entry in candidates if entry['data_fingerprint'] == data_fingerprint]
+        candidates = exact or [entry for entry in candidates if entry.get('reference')]
+        return max(candidates, key=lambda entry: entry['version']) if candidates else None
+
+    def promote(self, key, reference=True):
+        """Mark a registered model as a reference, reusable for data it was not trained on"""
+        with self.registry_lock:
+            self.manifest.update(self.load_manifest())
+            if key not in self.manifest:
+                raise KeyError(f"Модель {key} не найдена в реестре.")
+            if reference and (self.manifest[key].get('training_rows') or 0) < MIN_REFERENCE_TRAINING_ROWS:
+                raise ValueError(f"Эталонная модель должна быть обучена минимум на {MIN_REFERENCE_TRAINING_ROWS} строках.")
+            self.manifest[key]['reference'] = reference
+            self.save_manifest()
+        return self.manifest[key]
+
+    def promote_models(self, model_details):
+        """Promote the registered models behind an analysis' model details; returns the names promoted.
+        Models trained on too few rows are skipped."""
+        promoted = []
+        for model_name, details in model_details.items():
+            key = details.get('model_key')
+            if key is None:
+                continue
+            try:
+                self.promote(key)
+                promoted.append(model_name)
+            except (KeyError, ValueError) as e:
+                print(f"Warning: Could not promote model {model_name}: {str(e)}")
+        return promoted
+
+    def load(self, entry, module_class=None):
+        key = entry['key']
+        with self.registry_lock:
+            if key in self.loaded_models:
+                self.loaded_models.move_to_end(key)
+                return self.loaded_models[key]
+
+        artifact = joblib.load(self._artifact_path(key))
+        if artifact['kind'] == 'torch':
+            model = module_class(**artifact['init_args'])
+            model.load_state_dict(artifact['state_dict'])
+            model.eval()
+        else:
+            model = artifact['model']
+
+        with self.registry_lock:
+            self.loaded_models[key] = model
+            while len(self.loaded_models) > self.max_loaded_models:
+                self.loaded_models.popitem(last=False)
+            self.manifest.setdefault(key, entry)['last_used'] = datetime.now().isoformat()
+            self.save_manifest()
+        return model
+
+    def save(self, model, model_type, feature_schema, params, data_fingerprint, init_args=None, training_rows=None):
+        """Store a fitted model as the next version of its lineage; torch modules are kept as state_dicts"""
+        if isinstance(model, torch.nn.Module):
+            artifact = {'kind': 'torch', 'init_args': init_args or {}, 'state_dict': model.state_dict()}
+        else:
+            artifact = {'kind': 'estimator', 'model': model}
+
+        key = uuid.uuid4().hex
+        artifact_path = self._artifact_path(key)
+        temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+        joblib.dump(artifact, temp_path)
+        os.replace(temp_path, artifact_path)
+
+        lineage = self._lineage(model_type, feature_schema, params)
+        with self.registry_lock:
+            self.manifest.update(self.load_manifest())
+            version = 1 + max((entry['version'] for entry in self.manifest.values() if entry['lineage'] == lineage), default=0)
+            now = datetime.now().isoformat()
+            entry = {
+                'key': key,
+                'lineage': lineage,
+                'model_type': model_type,
+                'feature_schema': feature_schema,
+                'params': params,
+                'data_fingerprint': data_fingerprint,
+                'training_rows': training_rows,
+                'reference': False,
+                'version': version,
+                'format': REGISTRY_FORMAT_VERSION,
+                'libraries': self._library_versions(),
+                'size': os.path.getsize(artifact_path),
+                'created': now,
+                'last_used': now
+            }
+            self.manifest[key] = entry
+            self.loaded_models[key] = model
+            self.evict(keep=key)
+            self.save_manifest()
+        return entry
+
+    def get_or_train(self, model_type, train_fn, feature_columns, params, data_fingerprint,
+                     retrain=False, module_class=None, init_args=None, training_rows=None):
+        """Warm-load a compatible fitted model, training (and registering) one only when none exists or on request.
+        Returns (model, entry, trained)."""
+        feature_schema = schema_hash(feature_columns)
+        if not retrain:
+            entry = self.find(model_type, feature_schema, params, data_fingerprint)
+            if entry is not None:
+                try:
+                    return self.load(entry, module_class=module_class), entry, False
+                except Exception as e:
+                    print(f"Warning: Could not load registered model {entry['key']}: {str(e)}")
+
+        model = train_fn()
+        try:
+            entry = self.save(model, model_type, feature_schema, params, data_fingerprint, init_args=init_args,
+                              training_rows=training_rows)
+        except Exception as e:
+            print(f"Warning: Could not register model: {str(e)}")
+            entry = None
+        return model, entry, True
+
+    def remove(self, key):
+        self.manifest.pop(key, None)
+        self.loaded_models.pop(key, None)
+        path = self._artifact_path(key)
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Warning: Could not remove model artifact: {str(e)}")
+
+    def evict(self, keep=None):
+        """Drop least recently used artifacts (and stale formats) until the registry fits its size budget"""
+        for key, entry in list(self.manifest.items()):
+            if key != keep and not self._is_loadable(entry):
+                self.remove(key)
+
+        max_bytes = self.max_registry_size_mb * 1024 * 1024
+        total_bytes = sum(entry['size'] for entry in self.manifest.values())
+        for entry in sorted(self.manifest.values(), key=lambda entry: entry['last_used']):
+            if total_bytes <= max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            self.remove(entry['key'])
+            total_bytes -= entry['size']
+
+model_registry = ModelRegistry()
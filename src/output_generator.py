@@ -222,7 +222,7 @@ def export_all_results(df, fraud_scores, is_suspicious, model_details, rules_fla
     except Exception as e:
         return f"<html><body><h1>Error generating report: {str(e)}</h1></body></html>"
 
-def export_json_summary(df, fraud_scores, is_suspicious, model_details, rules_flags):
+def export_json_summary(df, fraud_scores, is_suspicious, model_details, rules_flags, rule_stats=None):
     try:
         summary = {
             "dataset_info": {
@@ -232,6 +232,7 @@ def export_json_summary(df, fraud_scores, is_suspicious, model_details, rules_fl
                 "avg_fraud_score": float(np.mean(fraud_scores))
             },
             "model_performance": {},
+            "rule_performance": rule_stats.to_dict() if rule_stats is not None else [],
             "top_suspicious_transactions": []
         }
         
@@ -240,7 +241,10 @@ def export_json_summary(df, fraud_scores, is_suspicious, model_details, rules_fl
                 model_name: {
                     "weight": float(details.get('weight', 0)),
                     "anomalies_detected": int(details.get('anomaly_count', 0)),
-                    "avg_score": float(details.get('mean_score', 0))
+                    "avg_score": float(details.get('mean_score', 0)),
+                    "execution_time_s": float(details.get('execution_time', 0)),
+                    "dispatch_cpu_time_s": float(details.get('dispatch_cpu_time', 0)),
+                    "queue_wait_s": float(details.get('queue_wait', 0))
                 }
                 for model_name, details in model_details.items()
             }
@@ -0,0 +1,150 @@
+import numpy as np
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.data_processor import data_processor
+from src.advanced_models import advanced_model_pipeline
+from src.rules import rule_engine, profile_rules, compiled_rules, RuleStats
+from src.feature_store import FeatureStore, feature_matrix_store
+from src.resource_governor import resource_governor
+from src.quantile_sketch import QuantileSketch, quantile_sketch_store
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+def plan_workers(n_files, max_workers=None, task_mb=0):
+    """Split the CPUs between file workers so workers x threads never exceeds the core count
+    and the concurrent files fit in the memory budget"""
+    cpu_count = os.cpu_count() or 1
+    workers = resource_governor.worker_count(n_files, task_mb=task_mb, max_workers=max_workers)
+    threads_per_worker = max(1, cpu_count // workers)
+    return workers, threads_per_worker
+
+def limit_threads(threads):
+    resource_governor.thread_budget = threads
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except Exception:
+        pass
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads)
+    except Exception:
+        pass
+
+def score_frame(df_processed, model_types, contamination, feature_store=None, data_key=None, retrain=False,
+                amount_sketch=None):
+    """Score a processed frame; amount_sketch, e.g. merged from per-file sketches, replaces one built from the frame"""
+    fraud_scores, anomalies, model_details = advanced_model_pipeline(
+        df_processed,
+        model_types=model_types,
+        contamination=contamination,
+        feature_store=feature_store,
+        data_key=data_key,
+        retrain=retrain
+    )
+
+    if amount_sketch is None:
+        amount_sketch = QuantileSketch.from_values(df_processed['amount'].to_numpy())
+    large_amount_threshold = amount_sketch.quantile(0.95)
+    rule_stats = RuleStats(compiled_rules.names, compiled_rules.bits)
+    rules_combined, rules_mask = rule_engine(df_processed, large_amount_threshold=large_amount_threshold, stats=rule_stats)
+    rule_stats.record_overlap(rules_mask, anomalies)
+    rule_stats.record_timing(profile_rules(df_processed, large_amount_threshold=large_amount_threshold))
+
+    normalized_ml_scores = (fraud_scores - np.min(fraud_scores)) / (np.max(fraud_scores) - np.min(fraud_scores) + 1e-8)
+    combined_scores = 0.7 * normalized_ml_scores + 0.3 * rules_combined
+
+    score_sketch = QuantileSketch.from_values(combined_scores)
+    suspicious_threshold = score_sketch.quantile(0.95)
+    is_suspicious = combined_scores > suspicious_threshold
+
+    return {
+        'fraud_scores': fraud_scores,
+        'anomalies': anomalies,
+        'model_details': model_details,
+        'rules_combined': rules_combined,
+        'rules_mask': rules_mask,
+        'rule_stats': rule_stats,
+        'combined_scores': combined_scores,
+        'is_suspicious': is_suspicious,
+        'suspicious_threshold': suspicious_threshold,
+        'quantile_sketches': {'amount': amount_sketch, 'combined_score': score_sketch}
+    }
+
+def analyze_source(source, file_name, model_types, contamination, threads=None, retrain=False, return_frame=True):
+    """Full analysis of one file; file workers pass return_frame=False so the frame is reloaded from the cache
+    by the parent instead of being pickled back"""
+    if threads is not None:
+        limit_threads(threads)
+
+    start_time = time.time()
+    file_hash = data_processor.get_file_hash(source)
+    df_processed, from_cache = data_processor.load_and_preprocess(source, file_name=file_name, file_hash=file_hash)
+    feature_matrix, feature_columns = feature_matrix_store.get_or_write(df_processed, file_hash)
+    feature_store = FeatureStore(feature_matrix, feature_columns, index=df_processed.index)
+    analysis = score_frame(df_processed, model_types, contamination, feature_store=feature_store, data_key=file_hash,
+                           retrain=retrain)
+    quantile_sketch_store.save(file_hash, analysis['quantile_sketches'])
+    analysis.update({
+        'df_processed': df_processed if return_frame else None,
+        'feature_key': file_hash,
+        'from_cache': from_cache,
+        'execution_time': time.time() - start_time
+    })
+    return analysis
+
+def analyze_files_parallel(sources, model_types, contamination, max_workers=None, retrain=False):
+    """Analyse (file_name, source) pairs concurrently, yielding (position, file_name, analysis, error) as each finishes;
+    position is the pair's index in sources, since file names need not be unique. The workers' sketches are merged
+    and stored under the key a combined analysis of the same files uses."""
+    merged_sketches = {}
+    file_hashes = {}
+    for position, file_name, analysis, error in analyze_files(sources, model_types, contamination, max_workers, retrain):
+        if analysis is not None:
+            file_hashes[position] = analysis['feature_key']
+            for name, sketch in analysis['quantile_sketches'].items():
+                merged_sketches.setdefault(name, QuantileSketch()).merge(sketch)
+        yield position, file_name, analysis, error
+
+    if len(file_hashes) > 1:
+        sources_key = data_processor.combine_hashes([file_hashes[position] for position in sorted(file_hashes)])
+        quantile_sketch_store.save(sources_key, merged_sketches)
+
+def analyze_files(sources, model_types, contamination, max_workers=None, retrain=False):
+    if not sources:
+        return
+
+    task_mb = max(resource_governor.estimate_frame_mb(data_processor.get_source_size(source)) for _, source in sources)
+    workers, threads_per_worker = plan_workers(len(sources), max_workers, task_mb=task_mb)
+
+    if workers == 1:
+        for position, (file_name, source) in enumerate(sources):
+            try:
+                yield position, file_name, analyze_source(source, file_name, model_types, contamination, retrain=retrain), None
+            except Exception as e:
+                yield position, file_name, None, e
+        return
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(analyze_source, source, file_name, model_types, contamination, threads_per_worker, retrain,
+                            False): position
+            for position, (file_name, source) in enumerate(sources)
+        }
+        for future in as_completed(futures):
+            position = futures[future]
+            file_name, source = sources[position]
+            try:
+                analysis = future.result()
+                analysis['df_processed'], _ = data_processor.load_and_preprocess(source, file_name=file_name,
+                                                                                 file_hash=analysis['feature_key'])
+                yield position, file_name, analysis, None
+            except Exception as e:
+                yield position, file_name, None, e
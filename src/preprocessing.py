@@ -1,22 +1,381 @@
+import io
+import os
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import LabelEncoder
+from src.vocabulary import category_vocabulary
 import warnings
 warnings.filterwarnings('ignore')
 
-def load_data(file_path):
+try:
+    import python_calamine
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
+
+REQUIRED_COLUMNS = ['step', 'type', 'amount', 'nameOrig', 'oldbalanceOrg',
+                    'newbalanceOrig', 'nameDest', 'oldbalanceDest', 'newbalanceDest']
+NUMERIC_COLUMNS = ['step', 'amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
+LABEL_COLUMNS = ['isFraud', 'isFlaggedFraud']
+ACCOUNT_COLUMNS = ['nameOrig', 'nameDest']
+
+TRANSACTION_SCHEMA = {
+    'step': np.int32,
+    'type': 'category',
+    'amount': np.float64,
+    'nameOrig': object,
+    'oldbalanceOrg': np.float64,
+    'newbalanceOrig': np.float64,
+    'nameDest': object,
+    'oldbalanceDest': np.float64,
+    'newbalanceDest': np.float64,
+    'isFraud': np.int8,
+    'isFlaggedFraud': np.int8
+}
+
+LENIENT_READ_DTYPES = {'type': 'category', 'nameOrig': object, 'nameDest': object}
+
+VELOCITY_WINDOWS = [1, 24, 168]
+VELOCITY_WINDOW = 24
+MIN_VELOCITY_HISTORY = 2
+# payee pairs remembered across chunks (8 bytes each); past this the oldest pairs are forgotten
+SEEN_PAIR_LIMIT = 16_000_000
+CUSTOMER_FEATURE_COLUMNS = (['stepsSincePrev', 'amountToMeanRatio'] +
+                            [f'{name}{window}' for window in VELOCITY_WINDOWS for name in ('txnCount', 'amountSum')] +
+                            ['velocityCountRatio', 'velocityAmountRatio', 'isNewPayee'])
+
+def is_schema_column(column):
+    return column in TRANSACTION_SCHEMA
+
+class AccountVocabulary:
+    """Account IDs seen so far across the chunks of one source, in a dict grown by each chunk's new IDs only;
+    an ID keeps the code it got when first seen"""
+    
+    def __init__(self):
+        self.codes = {}
+    
+    def encode(self, ids):
+        codes = self.codes
+        return np.fromiter((codes.setdefault(account_id, len(codes)) for account_id in ids), dtype=np.int64, count=len(ids))
+
+def intern_account_ids(df, columns=ACCOUNT_COLUMNS, vocabulary=None):
+    """Encode account ID columns as categoricals over one shared dictionary of the frame's own IDs; with a
+    vocabulary the categories follow its first-seen order, so IDs compare the same way in every chunk"""
+    columns = [col for col in columns if col in df.columns]
+    if not columns:
+        return df
+    
+    column_ids = []
+    for col in columns:
+        values = df[col].astype(object)
+        column_ids.append(values.where(values.notna(), 'UNKNOWN').astype(str).to_numpy(dtype=object))
+    
+    codes, shared_ids = pd.factorize(np.concatenate(column_ids))
+    if vocabulary is not None:
+        order = np.argsort(vocabulary.encode(shared_ids), kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        shared_ids, codes = shared_ids[order], rank[codes]
+    categories = pd.Index(shared_ids, dtype=object)
+    for position, col in enumerate(columns):
+        column_codes = codes[position * len(df):(position + 1) * len(df)]
+        df[col] = pd.Categorical.from_codes(column_codes, categories=categories)
+    return df
+
+def account_codes(series):
+    """Integer keys for an account ID column (categorical codes when interned)"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy()
+    return pd.factorize(series)[0].astype(np.int32)
+
+def sorted_groups(codes, steps):
+    """Row order sorted by (code, step), stable within equal steps, with group start positions"""
+    order = np.lexsort((steps, codes))
+    sorted_codes = codes[order]
+    
+    positions = np.arange(len(order))
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    return order, sorted_codes, steps[order], group_start
+
+def customer_order(df):
+    codes = account_codes(df['nameOrig']).astype(np.int64)
+    return sorted_groups(codes, df['step'].to_numpy(dtype=np.int64))
+
+def payee_pair_hashes(df):
+    return pd.util.hash_pandas_object(df[ACCOUNT_COLUMNS], index=False).to_numpy()
+
+class CustomerHistory:
+    """Per-customer state carried between streamed chunks so lag and window features stay exact.
+    Chunks are expected in step order, as transaction logs are written."""
+    
+    def __init__(self):
+        # customer name -> row of the arrays below; a dict grows by each chunk's new customers only
+        self.positions = {}
+        self.count = np.zeros(0)
+        self.amount_sum = np.zeros(0)
+        self.first_step = np.zeros(0, dtype=np.int64)
+        self.last_step = np.zeros(0, dtype=np.int64)
+        self.tail_names = np.array([], dtype=object)
+        self.tail_steps = np.zeros(0, dtype=np.int64)
+        self.tail_amounts = np.zeros(0)
+        # sorted, disjoint runs of payee-pair hashes, oldest and largest first; merged like a log-structured tree
+        self.seen_pair_runs = []
+    
+    def _positions(self, uniques):
+        get = self.positions.get
+        return np.fromiter((get(name, -1) for name in uniques), dtype=np.int64, count=len(uniques))
+    
+    def lookup(self, uniques):
+        """Totals for each key in uniques; customers never seen get zero counts and -1 steps"""
+        positions = self._positions(uniques)
+        known = positions >= 0
+        if not known.any():
+            return np.zeros(len(uniques)), np.zeros(len(uniques)), np.full(len(uniques), -1), np.full(len(uniques), -1)
+        
+        positions = np.where(known, positions, 0)
+        count = np.where(known, self.count[positions], 0)
+        amount_sum = np.where(known, self.amount_sum[positions], 0.0)
+        first_step = np.where(known, self.first_step[positions], -1)
+        last_step = np.where(known, self.last_step[positions], -1)
+        return count, amount_sum, first_step, last_step
+    
+    def update(self, names, codes, steps, amounts, pair_hashes, n_tail):
+        chunk_codes, uniques = pd.factorize(names[n_tail:])
+        chunk_steps = steps[n_tail:]
+        n_uniques = len(uniques)
+        
+        count = np.bincount(chunk_codes, minlength=n_uniques)
+        amount_sum = np.bincount(chunk_codes, weights=amounts[n_tail:], minlength=n_uniques)
+        first_step = np.full(n_uniques, np.iinfo(np.int64).max)
+        np.minimum.at(first_step, chunk_codes, chunk_steps)
+        last_step = np.full(n_uniques, -1, dtype=np.int64)
+        np.maximum.at(last_step, chunk_codes, chunk_steps)
+        
+        positions = self._positions(uniques)
+        known = positions >= 0
+        self.count[positions[known]] += count[known]
+        self.amount_sum[positions[known]] += amount_sum[known]
+        self.last_step[positions[known]] = np.maximum(self.last_step[positions[known]], last_step[known])
+        
+        new_names = uniques[~known]
+        self.positions.update(zip(new_names, range(len(self.count), len(self.count) + len(new_names))))
+        self.count = np.concatenate([self.count, count[~known]])
+        self.amount_sum = np.concatenate([self.amount_sum, amount_sum[~known]])
+        self.first_step = np.concatenate([self.first_step, first_step[~known]])
+        self.last_step = np.concatenate([self.last_step, last_step[~known]])
+        
+        keep = steps > steps.max() - max(VELOCITY_WINDOWS) if len(steps) else np.zeros(0, dtype=bool)
+        self.tail_names = names[keep]
+        self.tail_steps = steps[keep]
+        self.tail_amounts = amounts[keep]
+        self.remember_pairs(pair_hashes)
+    
+    def has_seen_pairs(self, pair_hashes):
+        seen = np.zeros(len(pair_hashes), dtype=bool)
+        for run in self.seen_pair_runs:
+            positions = np.minimum(np.searchsorted(run, pair_hashes), len(run) - 1)
+            seen |= run[positions] == pair_hashes
+        return seen
+    
+    def remember_pairs(self, pair_hashes):
+        """Add a chunk's pairs as a new run, merging runs of similar size so the total work stays O(n log n)"""
+        new_pairs = np.unique(pair_hashes)
+        new_pairs = new_pairs[~self.has_seen_pairs(new_pairs)]
+        if len(new_pairs) == 0:
+            return
+        self.seen_pair_runs.append(new_pairs)
+        while len(self.seen_pair_runs) > 1 and len(self.seen_pair_runs[-1]) >= len(self.seen_pair_runs[-2]):
+            newest = self.seen_pair_runs.pop()
+            self.seen_pair_runs[-1] = np.sort(np.concatenate([self.seen_pair_runs[-1], newest]), kind='mergesort')
+        while sum(len(run) for run in self.seen_pair_runs) > SEEN_PAIR_LIMIT and len(self.seen_pair_runs) > 1:
+            self.seen_pair_runs.pop(0)
+
+def add_customer_features(df, history=None):
+    """Per-customer lag and velocity features computed from one sort by (nameOrig, step).
+    With a CustomerHistory the features continue from the previous chunks and the history is advanced."""
+    n_chunk = len(df)
+    steps = df['step'].to_numpy(dtype=np.int64)
+    amounts = df['amount'].to_numpy(dtype=np.float64)
+    
+    if history is None:
+        n_tail = 0
+        codes = account_codes(df['nameOrig']).astype(np.int64)
+        n_codes = int(codes.max()) + 1 if n_chunk else 0
+        older_count, older_sum = np.zeros(max(n_codes, 1)), np.zeros(max(n_codes, 1))
+        known_first, known_last = np.full(max(n_codes, 1), -1), np.full(max(n_codes, 1), -1)
+    else:
+        n_tail = len(history.tail_names)
+        names = np.concatenate([history.tail_names, df['nameOrig'].to_numpy(dtype=object)])
+        codes, uniques = pd.factorize(names)
+        codes = codes.astype(np.int64)
+        steps = np.concatenate([history.tail_steps, steps])
+        amounts = np.concatenate([history.tail_amounts, amounts])
+        
+        known_count, known_sum, known_first, known_last = history.lookup(uniques)
+        older_count = known_count - np.bincount(codes[:n_tail], minlength=len(uniques))
+        older_sum = known_sum - np.bincount(codes[:n_tail], weights=amounts[:n_tail], minlength=len(uniques))
+    
+    n_rows = len(codes)
+    order, sorted_codes, sorted_steps, group_start = sorted_groups(codes, steps)
+    positions = np.arange(n_rows)
+    sorted_amounts = amounts[order]
+    amount_cumsum = np.concatenate([[0.0], np.cumsum(sorted_amounts)])
+    
+    within_count = positions - group_start
+    prior_count = within_count + older_count[sorted_codes]
+    prior_sum = amount_cumsum[positions] - amount_cumsum[group_start] + older_sum[sorted_codes]
+    has_prev = prior_count > 0
+    
+    previous_step = np.where(within_count > 0, sorted_steps[np.maximum(positions - 1, 0)], known_last[sorted_codes])
+    steps_since_prev = np.where(has_prev & (previous_step >= 0), sorted_steps - previous_step, 0).astype(np.float32)
+    
+    prior_mean = np.divide(prior_sum, prior_count, out=np.zeros(n_rows), where=has_prev)
+    amount_ratio = np.ones(n_rows)
+    amount_ratio[has_prev] = sorted_amounts[has_prev] / (prior_mean[has_prev] + 1e-6)
+    
+    features = {
+        'stepsSincePrev': steps_since_prev,
+        'amountToMeanRatio': amount_ratio.astype(np.float32)
+    }
+    
+    span = int(sorted_steps.max() - min(sorted_steps.min(), 0)) + max(VELOCITY_WINDOWS) + 1 if n_rows else 1
+    sort_keys = sorted_codes * span + sorted_steps
+    for window in VELOCITY_WINDOWS:
+        window_start = np.searchsorted(sort_keys, sort_keys - window, side='right')
+        features[f'txnCount{window}'] = (positions - window_start + 1).astype(np.int32)
+        features[f'amountSum{window}'] = (amount_cumsum[positions + 1] - amount_cumsum[window_start]).astype(np.float32)
+    
+    first_step = np.where(known_first[sorted_codes] >= 0, known_first[sorted_codes], sorted_steps[group_start])
+    elapsed_windows = np.maximum(1.0, (sorted_steps - first_step) / VELOCITY_WINDOW)
+    enough_history = prior_count >= MIN_VELOCITY_HISTORY
+    # expected activity per window never drops below one average transaction
+    count_rate = np.maximum(prior_count / elapsed_windows, 1.0)
+    amount_rate = np.maximum(prior_sum / elapsed_windows, prior_mean)
+    features['velocityCountRatio'] = np.where(
+        enough_history, features[f'txnCount{VELOCITY_WINDOW}'] / count_rate, 1.0).astype(np.float32)
+    # a single large transfer is the large-amount rule's concern; velocity needs repeated activity
+    repeated = features[f'txnCount{VELOCITY_WINDOW}'] >= 2
+    features['velocityAmountRatio'] = np.where(
+        enough_history & repeated, features[f'amountSum{VELOCITY_WINDOW}'] / (amount_rate + 1e-6), 1.0).astype(np.float32)
+    
+    inverse = np.empty(n_rows, dtype=np.int64)
+    inverse[order] = positions
+    chunk_rows = inverse[n_tail:]
+    for name, values in features.items():
+        df[name] = values[chunk_rows]
+    
+    pair_hashes = payee_pair_hashes(df)
+    step_order = np.argsort(steps[n_tail:], kind='stable')
+    first_seen = ~pd.Series(pair_hashes[step_order]).duplicated().to_numpy()
+    if history is not None:
+        first_seen &= ~history.has_seen_pairs(pair_hashes[step_order])
+    is_new_payee = np.empty(n_chunk, dtype=np.int8)
+    is_new_payee[step_order] = first_seen
+    df['isNewPayee'] = is_new_payee
+    
+    if history is not None:
+        history.update(names, codes, steps, amounts, pair_hashes, n_tail)
+    return df
+
+def apply_transaction_schema(df, vocabulary=None):
+    """Cast a raw transaction frame to the declared dtypes; money stays float64 so cents survive large balances"""
+    for col in NUMERIC_COLUMNS + LABEL_COLUMNS:
+        if col not in df.columns:
+            continue
+        target_dtype = TRANSACTION_SCHEMA[col]
+        if df[col].dtype == target_dtype:
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        if np.issubdtype(np.dtype(target_dtype), np.integer) and values.isnull().any():
+            target_dtype = np.float32
+        df[col] = values.astype(target_dtype)
+    
+    if 'type' in df.columns and not isinstance(df['type'].dtype, pd.CategoricalDtype):
+        df['type'] = df['type'].fillna('UNKNOWN').astype(str).astype('category')
+    
+    return intern_account_ids(df, vocabulary=vocabulary)
+
+def read_transactions_csv(file_path_or_buffer, **kwargs):
+    """Read a transactions CSV restricted to schema columns with declared dtypes"""
+    try:
+        return pd.read_csv(file_path_or_buffer, usecols=is_schema_column, dtype=TRANSACTION_SCHEMA, **kwargs)
+    except (ValueError, TypeError):
+        if hasattr(file_path_or_buffer, 'seek'):
+            file_path_or_buffer.seek(0)
+        return pd.read_csv(file_path_or_buffer, usecols=is_schema_column, low_memory=False,
+                           dtype=LENIENT_READ_DTYPES, **kwargs)
+
+class MemoryViewReader(io.RawIOBase):
+    """Seekable read-only stream over a memoryview, so uploads are parsed without a copy"""
+    
+    def __init__(self, data):
+        self.view = memoryview(data).cast('B')
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, min(offset, len(self.view)))
+        return self.position
+    
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.view) - self.position)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+    
+    def close(self):
+        self.view.release()
+        super().close()
+
+def get_source_name(source, file_name=None):
+    if file_name:
+        return file_name
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, 'name', '')
+
+def open_source(source):
+    """Path strings pass through; file-like objects are rewound; raw buffers are wrapped without copying"""
+    if isinstance(source, (str, os.PathLike)):
+        return source
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return source
+    return io.BufferedReader(MemoryViewReader(source))
+
+def read_transactions_excel(file_path_or_buffer):
+    """Read every sheet that carries the transaction columns, restricted to schema columns"""
+    sheets = pd.read_excel(file_path_or_buffer, sheet_name=None, usecols=is_schema_column, engine=EXCEL_ENGINE)
+    frames = [sheet for sheet in sheets.values() if all(col in sheet.columns for col in REQUIRED_COLUMNS)]
+    if not frames:
+        return next(iter(sheets.values()), pd.DataFrame())
+    return pd.concat(frames, ignore_index=True)
+
+def load_data(file_path, file_name=None):
     try:
-        if file_path.endswith('.csv'):
-            df = pd.read_csv(file_path, low_memory=False)
-        elif file_path.endswith('.xlsx'):
-            df = pd.read_excel(file_path)
+        source_name = get_source_name(file_path, file_name).lower()
+        source = open_source(file_path)
+        if source_name.endswith('.csv'):
+            df = read_transactions_csv(source)
+        elif source_name.endswith('.xlsx'):
+            df = read_transactions_excel(source)
         else:
             raise ValueError("Неподдерживаемый формат файла. Используйте CSV или Excel файлы.")
         
-        required_columns = ['step', 'type', 'amount', 'nameOrig', 'oldbalanceOrg', 
-                          'newbalanceOrig', 'nameDest', 'oldbalanceDest', 'newbalanceDest']
-        
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
         if missing_columns:
             raise ValueError(f"Отсутствуют обязательные столбцы: {missing_columns}")
         
@@ -28,7 +387,7 @@ def load_data(file_path):
         if len(df) < 2:
             raise ValueError("Недостаточно данных для анализа. Файл должен содержать минимум 2 строки.")
         
-        return df
+        return apply_transaction_schema(df)
     except FileNotFoundError:
         raise Exception(f"Файл не найден: {file_path}")
     except pd.errors.EmptyDataError:
@@ -38,63 +397,70 @@ def load_data(file_path):
     except Exception as e:
         raise Exception(f"Ошибка загрузки данных: {str(e)}")
 
-def preprocess(df):
+def numeric_values(series, dtype=None):
+    """Column as a numpy array, coercing only when the dtype is not already numeric"""
+    if not pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        series = pd.to_numeric(series, errors='coerce')
+    return series.to_numpy(dtype=dtype or series.dtype)
+
+def preprocess(df, max_rows=None, extend_vocabulary=True, inplace=False, history=None):
     try:
         if df.empty:
             raise ValueError("Пустой набор данных для предобработки.")
         
-      
-        if len(df) > 50000:
-       
-            sample_size = min(50000, len(df))
-            df = df.sample(n=sample_size, random_state=42)
+        if max_rows is not None and len(df) > max_rows:
+            df = df.sample(n=max_rows, random_state=42)
         
-        df_processed = df.copy()
+        # new columns are assigned, never written through, so a shallow copy keeps the input intact
+        df_processed = df if inplace else df.copy(deep=False)
         
         
-        required_columns = ['step', 'type', 'amount', 'nameOrig', 'oldbalanceOrg', 
-                          'newbalanceOrig', 'nameDest', 'oldbalanceDest', 'newbalanceDest']
-        missing_columns = [col for col in required_columns if col not in df_processed.columns]
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df_processed.columns]
         if missing_columns:
             raise ValueError(f"Отсутствуют обязательные столбцы: {missing_columns}")
         
      
-        numeric_columns = ['step', 'amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
-        for col in numeric_columns:
-            df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce')
+        all_null = True
+        for col in NUMERIC_COLUMNS:
+            values = numeric_values(df_processed[col])
+            if values.dtype.kind == 'f':
+                missing = np.isnan(values)
+                all_null = all_null and bool(missing.all())
+                values = np.abs(np.where(missing, 0, values)).astype(values.dtype, copy=False)
+            else:
+                all_null = all_null and len(values) == 0
+                values = np.abs(values)
+            df_processed[col] = values
         
-
-        if df_processed[numeric_columns].isnull().all().all():
+        if all_null:
             raise ValueError("Все числовые столбцы содержат некорректные данные.")
         
- 
-        df_processed[numeric_columns] = df_processed[numeric_columns].fillna(0)
-        
-       
-        df_processed[numeric_columns] = df_processed[numeric_columns].abs()
+        amount = df_processed['amount'].to_numpy()
+        df_processed['errorBalanceOrig'] = df_processed['oldbalanceOrg'].to_numpy() - df_processed['newbalanceOrig'].to_numpy() - amount
+        df_processed['errorBalanceDest'] = df_processed['newbalanceDest'].to_numpy() - df_processed['oldbalanceDest'].to_numpy() - amount
         
-
-        df_processed['errorBalanceOrig'] = df_processed['oldbalanceOrg'] - df_processed['newbalanceOrig'] - df_processed['amount']
-        df_processed['errorBalanceDest'] = df_processed['newbalanceDest'] - df_processed['oldbalanceDest'] - df_processed['amount']
+        steps = df_processed['step'].to_numpy()
+        df_processed['hour'] = steps % 24
+        df_processed['day_of_week'] = (steps // 24) % 7
         
-    
-        df_processed['hour'] = df_processed['step'] % 24
-        df_processed['day_of_week'] = (df_processed['step'] // 24) % 7
+        df_processed = add_customer_features(df_processed, history=history)
         
 
-        if 'isFraud' in df_processed.columns:
-            df_processed['isFraud'] = pd.to_numeric(df_processed['isFraud'], errors='coerce').fillna(0)
-        
-        if 'isFlaggedFraud' in df_processed.columns:
-            df_processed['isFlaggedFraud'] = pd.to_numeric(df_processed['isFlaggedFraud'], errors='coerce').fillna(0)
+        for col in LABEL_COLUMNS:
+            if col in df_processed.columns:
+                values = numeric_values(df_processed[col])
+                if values.dtype.kind == 'f':
+                    values = np.nan_to_num(values, nan=0.0)
+                df_processed[col] = values
         
 
         if 'type' in df_processed.columns:
-            type_encoder = LabelEncoder()
-            df_processed['type_encoded'] = type_encoder.fit_transform(df_processed['type'])
+            df_processed['type_encoded'] = category_vocabulary.encode('type', df_processed['type'], extend=extend_vocabulary)
         
 
-        df_processed = df_processed.fillna(0)
+        for col in df_processed.columns:
+            if not isinstance(df_processed[col].dtype, pd.CategoricalDtype) and df_processed[col].hasnans:
+                df_processed[col] = df_processed[col].fillna(0)
         
  
         if df_processed.empty:
@@ -0,0 +1,148 @@
+import numpy as np
+import os
+import json
+
+# capacity of the top compactor; rank error is roughly 1.7 / k
+DEFAULT_SKETCH_K = 400
+CAPACITY_DECAY = 2 / 3
+
+class QuantileSketch:
+    """KLL sketch: bounded-size quantile summary that is updated chunk by chunk and merged across files and workers"""
+
+    def __init__(self, k=DEFAULT_SKETCH_K, seed=42):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min_value = np.inf
+        self.max_value = -np.inf
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_values(cls, values, k=DEFAULT_SKETCH_K):
+        return cls(k=k).update(values)
+
+    def __len__(self):
+        return self.count
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k * CAPACITY_DECAY ** (len(self.levels) - level - 1))))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += len(values)
+        self.min_value = min(self.min_value, float(values.min()))
+        self.max_value = max(self.max_value, float(values.max()))
+        self._compress()
+        return self
+
+    def _compress(self):
+        """Halve every over-full level: sort it, keep every other item from a random offset and promote them"""
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                retained = items[len(items) - len(items) % 2:]
+                promoted = items[self.rng.integers(2):len(items) - len(items) % 2:2]
+                self.levels[level] = retained
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Approximate q-quantile (scalar or array of q); NaN while the sketch is empty"""
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else float('nan')
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 2.0 ** level) for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+
+        positions = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        values = items[np.clip(positions, 0, len(items) - 1)]
+        values = np.where(q <= 0, self.min_value, np.where(q >= 1, self.max_value, values))
+        return values if q.ndim else float(values)
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'count': self.count,
+            'min': self.min_value if self.count else None,
+            'max': self.max_value if self.count else None,
+            'levels': [items.tolist() for items in self.levels]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(k=data['k'])
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in data['levels']] or [np.empty(0)]
+        sketch.count = data['count']
+        if sketch.count:
+            sketch.min_value = data['min']
+            sketch.max_value = data['max']
+        return sketch
+
+class QuantileSketchStore:
+    """Named sketches per dataset key, one JSON file each, so thresholds survive between runs"""
+
+    def __init__(self, store_dir="models/quantile_sketches"):
+        self.store_dir = store_dir
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, f"{key}.json")
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    return {name: QuantileSketch.from_dict(data) for name, data in json.load(f).items()}
+        except Exception as e:
+            print(f"Warning: Could not load quantile sketches: {str(e)}")
+        return {}
+
+    def save(self, key, sketches):
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({name: sketch.to_dict() for name, sketch in sketches.items()}, f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"Warning: Could not save quantile sketches: {str(e)}")
+
+    def merged(self, keys, name):
+        """One sketch over several datasets, e.g. every file of a combined analysis"""
+        sketch = QuantileSketch()
+        for key in keys:
+            stored = self.load(key).get(name)
+            if stored is not None:
+                sketch.merge(stored)
+        return sketch
+
+quantile_sketch_store = QuantileSketchStore()
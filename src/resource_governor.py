@@ -0,0 +1,93 @@
+import os
+
+# stage: (minimum rows, preferred rows, approximate bytes held per sampled row)
+STAGE_SAMPLE_LIMITS = {
+    'isolation_forest': (1000, 5000, 512),
+    'lof': (200, 1000, 4096),
+    'autoencoder': (1000, 50000, 1024),
+    'reservoir': (5000, 50000, 2048)
+}
+
+# parsed frame + preprocessing features + feature matrix, relative to the file size on disk
+FRAME_MEMORY_FACTOR = 6.0
+
+class ResourceGovernor:
+
+    def __init__(self, memory_budget_mb=None, high_pressure=0.8, low_pressure=0.4, stage_budget_fraction=0.25):
+        self.memory_budget_mb = memory_budget_mb or self._default_budget_mb()
+        self.high_pressure = high_pressure
+        self.low_pressure = low_pressure
+        self.stage_budget_fraction = stage_budget_fraction
+        # threads this process may use, set when it runs as one of several file workers
+        self.thread_budget = None
+
+    def _default_budget_mb(self):
+        env_budget = os.environ.get('CLEARFLOW_MEMORY_BUDGET_MB')
+        if env_budget:
+            try:
+                return float(env_budget)
+            except ValueError:
+                print(f"Warning: Invalid CLEARFLOW_MEMORY_BUDGET_MB value: {env_budget}")
+        try:
+            import psutil
+            return psutil.virtual_memory().total / 1024 / 1024 * 0.6
+        except Exception:
+            return 4096.0
+
+    def memory_usage(self):
+        try:
+            import psutil
+            process = psutil.Process(os.getpid())
+            memory_info = process.memory_info()
+            return {
+                "rss": memory_info.rss / 1024 / 1024,
+                "vms": memory_info.vms / 1024 / 1024,
+                "percent": process.memory_percent(),
+                "available": psutil.virtual_memory().available / 1024 / 1024
+            }
+        except Exception:
+            return {"rss": 0, "vms": 0, "percent": 0, "available": 0}
+
+    def pressure(self, usage=None):
+        usage = usage or self.memory_usage()
+        return usage["rss"] / self.memory_budget_mb if self.memory_budget_mb else 0.0
+
+    def headroom_mb(self, usage=None):
+        """Memory still available to this process: the budget left, capped by what the OS has free"""
+        usage = usage or self.memory_usage()
+        headroom = self.memory_budget_mb - usage["rss"]
+        if usage["available"] > 0:
+            headroom = min(headroom, usage["available"])
+        return max(0.0, headroom)
+
+    def estimate_frame_mb(self, source_bytes):
+        return source_bytes / 1024 / 1024 * FRAME_MEMORY_FACTOR
+
+    def can_fit(self, required_mb):
+        return required_mb <= self.headroom_mb()
+
+    def chunk_size(self, chunk_size, min_size, max_size):
+        """Halve the chunk under memory pressure, double it while there is plenty of room"""
+        usage = self.memory_usage()
+        pressure = self.pressure(usage)
+        if pressure >= self.high_pressure:
+            return max(min_size, chunk_size // 2)
+        if 0 < pressure <= self.low_pressure:
+            return min(max_size, chunk_size * 2)
+        return chunk_size
+
+    def sample_size(self, stage, n_rows=None):
+        """Rows a stage may sample: its preferred cap, shrunk toward its minimum as headroom runs out"""
+        minimum, preferred, row_bytes = STAGE_SAMPLE_LIMITS[stage]
+        affordable = int(self.headroom_mb() * self.stage_budget_fraction * 1024 * 1024 / row_bytes)
+        size = max(minimum, min(preferred, affordable))
+        return size if n_rows is None else min(n_rows, size)
+
+    def worker_count(self, n_tasks, task_mb=0, max_workers=None):
+        cpu_count = self.thread_budget or os.cpu_count() or 1
+        workers = max(1, min(n_tasks, max_workers or cpu_count, cpu_count))
+        if task_mb > 0:
+            workers = max(1, min(workers, int(self.headroom_mb() // task_mb)))
+        return workers
+
+resource_governor = ResourceGovernor()
@@ -1,69 +1,417 @@
 import pandas as pd
 import numpy as np
+import ast
+import json
+import os
+import re
+import time
+from src.preprocessing import add_customer_features, CUSTOMER_FEATURE_COLUMNS
+from src.quantile_sketch import QuantileSketch
 
-def rule_engine(df):
+try:
+    import numexpr
+    NUMEXPR_AVAILABLE = True
+except ImportError:
+    NUMEXPR_AVAILABLE = False
+
+MAX_RULES = 63
+KERNEL_GROUP_SIZE = 16
+# rules are timed one by one on this many leading rows; the fused kernels cannot attribute time to single rules
+RULE_TIMING_ROWS = 50000
+# learned rules own the top bits of the mask, one fixed slot each counted down from the highest bit, so evicting
+# one never moves the others; they get at most this many slots, fewer when fixed rules need the bits
+LEARNED_RULE_SLOTS = 16
+# together, fired learned rules add at most this much weight, i.e. one default rule's worth
+LEARNED_WEIGHT_CAP = 1.0
+
+DEFAULT_RULES = [
+    {
+        'name': 'rule_large_amount',
+        'expression': 'amount > large_amount_threshold',
+        'weight': 1.0,
+        'label': {'ru': 'очень большая сумма', 'en': 'very large amount'}
+    },
+    {
+        'name': 'rule_new_destination',
+        'expression': 'oldbalanceDest == 0',
+        'weight': 1.0,
+        'label': {'ru': 'перевод на новый счет', 'en': 'transfer to a new account'}
+    },
+    {
+        'name': 'rule_balance_depletion',
+        'expression': '(oldbalanceOrg - newbalanceOrig) / (oldbalanceOrg + 1e-6) > threshold',
+        'threshold': 0.9,
+        'weight': 1.0,
+        'label': {'ru': 'опустошение счета', 'en': 'account depletion'}
+    },
+    {
+        'name': 'rule_unusual_time',
+        'expression': '(step % 24 >= 22) | (step % 24 <= 6)',
+        'weight': 1.0,
+        'label': {'ru': 'необычное время', 'en': 'unusual time'}
+    },
+    {
+        'name': 'rule_velocity_spike',
+        'expression': '(velocityCountRatio > threshold) | (velocityAmountRatio > threshold)',
+        'threshold': 3.0,
+        'weight': 1.0,
+        'label': {'ru': 'резкий скачок активности', 'en': 'activity spike'}
+    },
+    {
+        'name': 'rule_round_amount',
+        'expression': 'amount % 1000 == 0',
+        'weight': 1.0,
+        'label': {'ru': 'круглая сумма', 'en': 'round amount'}
+    }
+]
+
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.USub, ast.Invert,
+                 ast.BitAnd, ast.BitOr, ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq)
+
+RULE_PARAMETERS = ['large_amount_threshold']
+
+# (prefix before the triggered rules, text when nothing fired)
+EXPLANATION_TEMPLATES = {
+    'ru': ("Подозрительно из-за: ", "Нет подозрительных признаков"),
+    'en': ("Suspicious because of: ", "No suspicious signs")
+}
+
+def expression_names(expression, name):
+    """Names a rule expression references; raises ValueError for syntax outside the allowed arithmetic/comparison subset"""
     try:
-        if df.empty:
-            raise ValueError("Пустой набор данных для применения правил.")
-        
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Синтаксическая ошибка в правиле {name}: {expression} ({e.msg})")
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"Недопустимое выражение в правиле {name}: {expression}")
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+    return names
+
+def validate_rule(rule):
+    """Check one rule definition on its own, so a bad custom or learned rule can be dropped instead of failing the set"""
+    if not isinstance(rule, dict) or not isinstance(rule.get('name'), str) or not isinstance(rule.get('expression'), str):
+        raise ValueError(f"Правило должно содержать строковые поля name и expression: {rule!r}")
+    for key in ('weight', 'threshold'):
+        if key in rule and (isinstance(rule[key], bool) or not isinstance(rule[key], (int, float))):
+            raise ValueError(f"Поле {key} правила {rule['name']} должно быть числом.")
+    if 'slot' in rule and rule['slot'] is not None and (isinstance(rule['slot'], bool) or not isinstance(rule['slot'], int)):
+        raise ValueError(f"Поле slot правила {rule['name']} должно быть целым числом.")
+    if 'label' in rule and not isinstance(rule['label'], dict):
+        raise ValueError(f"Поле label правила {rule['name']} должно быть словарем с переводами.")
+    names = expression_names(rule['expression'], rule['name'])
+    if 'threshold' in names and 'threshold' not in rule:
+        raise ValueError(f"Правило {rule['name']} использует threshold, но не задает его.")
+    return rule
+
+class RuleStats:
+    """Per-rule wall time, rows evaluated, hits and overlap with ML anomalies, accumulated across evaluations.
+    Wall time only comes from rules evaluated one at a time, over timed_rows rows."""
+
+    def __init__(self, names, bits=None):
+        self.names = list(names)
+        self.bits = list(bits) if bits is not None else list(range(len(self.names)))
+        self.wall_time = np.zeros(len(self.names))
+        self.timed_rows = np.zeros(len(self.names), dtype=np.int64)
+        self.rows_evaluated = np.zeros(len(self.names), dtype=np.int64)
+        self.hits = np.zeros(len(self.names), dtype=np.int64)
+        self.anomaly_hits = np.zeros(len(self.names), dtype=np.int64)
+        self.anomaly_count = 0
+
+    def record(self, i, seconds, rows, hits):
+        self.wall_time[i] += seconds
+        self.timed_rows[i] += rows
+        self.rows_evaluated[i] += rows
+        self.hits[i] += hits
+
+    def record_kernel(self, group, rules_mask):
+        """Hits of a fused kernel's rules, from their bits of the mask"""
+        for i in group:
+            self.rows_evaluated[i] += len(rules_mask)
+            self.hits[i] += int(np.count_nonzero(rules_mask & (np.uint64(1) << np.uint64(self.bits[i]))))
+
+    def record_timing(self, timing):
+        """Take the wall time of a per-rule profiling run; hits and rows stay those of the full evaluation"""
+        if timing.names != self.names or timing.bits != self.bits:
+            raise ValueError("Статистика собрана для разных наборов правил.")
+        self.wall_time += timing.wall_time
+        self.timed_rows += timing.timed_rows
+        return self
+
+    def record_overlap(self, rules_mask, anomalies):
+        """Count, per rule, the rows it flagged that the ML models also called anomalous"""
+        anomalies = np.asarray(anomalies).astype(bool)
+        rules_mask = np.asarray(rules_mask, dtype=np.uint64)[anomalies]
+        self.anomaly_count += int(anomalies.sum())
+        for i, bit in enumerate(self.bits):
+            self.anomaly_hits[i] += int(np.count_nonzero(rules_mask & (np.uint64(1) << np.uint64(bit))))
+
+    def merge(self, other):
+        if other.names != self.names or other.bits != self.bits:
+            raise ValueError("Статистика собрана для разных наборов правил.")
+        self.wall_time += other.wall_time
+        self.timed_rows += other.timed_rows
+        self.rows_evaluated += other.rows_evaluated
+        self.hits += other.hits
+        self.anomaly_hits += other.anomaly_hits
+        self.anomaly_count += other.anomaly_count
+        return self
+
+    def to_frame(self):
+        rows = np.maximum(self.rows_evaluated, 1)
+        return pd.DataFrame({
+            'rule': self.names,
+            'wall_time_ms': self.wall_time * 1000,
+            'timed_rows': self.timed_rows,
+            'rows_evaluated': self.rows_evaluated,
+            'hits': self.hits,
+            'hit_rate': self.hits / rows,
+            'anomaly_overlap': self.anomaly_hits / np.maximum(self.hits, 1),
+            'anomaly_coverage': self.anomaly_hits / max(self.anomaly_count, 1),
+            'ns_per_row': self.wall_time * 1e9 / np.maximum(self.timed_rows, 1)
+        }).sort_values('ns_per_row', ascending=False, ignore_index=True)
+
+    def to_dict(self):
+        return self.to_frame().to_dict(orient='records')
+
+    def dead_rules(self):
+        return [name for name, hits, rows in zip(self.names, self.hits, self.rows_evaluated) if rows > 0 and hits == 0]
+
+class CompiledRuleSet:
+
+    def __init__(self, rules=None, custom_rules_path="models/custom_rules.json",
+                 learned_rules_path="models/learned_rules.json"):
+        self.base_rules = list(rules or DEFAULT_RULES)
+        self.custom_rules_path = custom_rules_path
+        self.learned_rules_path = learned_rules_path
+        self.reload()
+
+    def _load_rule_file(self, path, kind):
+        if not path or not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Warning: Could not load {kind} rules: {str(e)}")
+            return []
+
+    def load_learned_rules(self):
+        """Learned rule definitions as stored, each with its mask slot; rules from before slots get one by position"""
+        learned_rules = self._valid_rules(self._load_rule_file(self.learned_rules_path, 'learned'), 'learned', set())
+        used_slots = {rule['slot'] for rule in learned_rules if 'slot' in rule}
+        free_slots = iter(slot for slot in range(self.learned_slot_count) if slot not in used_slots)
+        for rule in learned_rules:
+            if 'slot' not in rule:
+                rule['slot'] = next(free_slots, None)
+        return self._slotted_rules(learned_rules)
+
+    def _slotted_rules(self, learned_rules):
+        """Learned rules whose slot fits next to the fixed rules; the rest are reported and dropped"""
+        kept = []
+        for rule in learned_rules:
+            if rule['slot'] is not None and 0 <= rule['slot'] < self.learned_slot_count:
+                kept.append(rule)
+            else:
+                print(f"Warning: Dropping learned rule {rule['name']}: "
+                      f"only {self.learned_slot_count} learned rule slots are free")
+        return kept
+
+    def _valid_rules(self, rules, kind, known_names):
+        """Rules that pass validation and do not reuse a name; the others are reported and skipped"""
+        if not isinstance(rules, list):
+            print(f"Warning: Skipping {kind} rules: expected a list of rule definitions")
+            return []
+        valid = []
+        for rule in rules:
+            try:
+                validate_rule(rule)
+                if rule['name'] in known_names:
+                    raise ValueError(f"Правило {rule['name']} уже определено.")
+            except ValueError as e:
+                print(f"Warning: Skipping invalid {kind} rule: {str(e)}")
+                continue
+            known_names.add(rule['name'])
+            valid.append(rule)
+        return valid
+
+    def reload(self):
+        """Recompile from the built-in, custom and learned rule definitions, e.g. after self-learning wrote new rules"""
+        known_names = {rule['name'] for rule in self.base_rules}
+        rules = self.base_rules + self._valid_rules(self._load_rule_file(self.custom_rules_path, 'custom'), 'custom', known_names)
+        if len(rules) > MAX_RULES:
+            print(f"Warning: Skipping {len(rules) - MAX_RULES} custom rules: at most {MAX_RULES} rules fit in the mask")
+            rules = rules[:MAX_RULES]
+        self.learned_slot_count = min(LEARNED_RULE_SLOTS, MAX_RULES - len(rules))
+        self.compile(rules + self._valid_rules(self.load_learned_rules(), 'learned', known_names))
+
+    def compile(self, rules):
+        fixed_rules = [rule for rule in rules if 'slot' not in rule]
+        if len(fixed_rules) > MAX_RULES:
+            raise ValueError(f"Слишком много правил: {len(fixed_rules)}. Максимум {MAX_RULES}.")
+        self.learned_slot_count = min(LEARNED_RULE_SLOTS, MAX_RULES - len(fixed_rules))
+        learned_rules = self._slotted_rules([rule for rule in rules if 'slot' in rule])
+        rules = fixed_rules + learned_rules
 
-        required_columns = ['amount', 'oldbalanceDest', 'oldbalanceOrg', 'newbalanceOrig', 'step', 'nameOrig']
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        self.rules = rules
+        self.names = [rule['name'] for rule in rules]
+        self.learned = np.array(['slot' in rule for rule in rules], dtype=bool)
+        self.bits = list(range(len(fixed_rules))) + [MAX_RULES - 1 - rule['slot'] for rule in learned_rules]
+        self.weights = np.array([rule.get('weight', 1.0) for rule in rules], dtype=np.float32)
+        self.thresholds = {f'threshold_{i}': rule['threshold'] for i, rule in enumerate(rules) if 'threshold' in rule}
+        self.expressions = [re.sub(r'\bthreshold\b', f'threshold_{i}', rule['expression']) for i, rule in enumerate(rules)]
+        self.columns = sorted(self._referenced_names() - set(self.thresholds) - set(RULE_PARAMETERS))
+        self.code = [compile(expression, f"<{name}>", 'eval') for expression, name in zip(self.expressions, self.names)]
+        self.explanation_tables = {}
+
+        # fused kernels over groups of rules (numexpr caps the operands per expression); static thresholds are inlined
+        inlined = [re.sub(r'\bthreshold_\d+\b', lambda match: repr(float(self.thresholds[match.group(0)])), expression)
+                   for expression in self.expressions]
+        self.inlined = inlined
+        self.kernels = []
+        for start in range(0, len(inlined), KERNEL_GROUP_SIZE):
+            group = range(start, min(start + KERNEL_GROUP_SIZE, len(inlined)))
+            mask_kernel = " + ".join(f"where({inlined[i]}, {1 << self.bits[i]}, 0)" for i in group)
+            score_kernels = [" + ".join(f"where({inlined[i]}, {float(self.weights[i])}, 0.0)"
+                                        for i in group if self.learned[i] == learned) or None
+                             for learned in (False, True)]
+            self.kernels.append((group, mask_kernel, *score_kernels))
+
+    def _referenced_names(self):
+        names = set()
+        for expression, name in zip(self.expressions, self.names):
+            names |= expression_names(expression, name)
+        return names
+
+    def bit(self, name):
+        return np.uint64(1) << np.uint64(self.bits[self.names.index(name)])
+
+    def _normalize_score(self, rules_score, learned_score):
+        """Default and custom rules set the scale; learned rules only add to it, up to LEARNED_WEIGHT_CAP"""
+        total_weight = float(self.weights[~self.learned].sum()) or 1.0
+        rules_score += np.minimum(learned_score, LEARNED_WEIGHT_CAP)
+        return np.clip(rules_score / total_weight, 0, 1).astype(np.float32)
+
+    def _context(self, df, large_amount_threshold):
+        if any(col in CUSTOMER_FEATURE_COLUMNS and col not in df.columns for col in self.columns):
+            df = add_customer_features(df.copy(deep=False))
+        context = {col: df[col].to_numpy() for col in self.columns}
+        context.update(self.thresholds)
+        context['large_amount_threshold'] = large_amount_threshold
+        return context
+
+    def evaluate(self, df, large_amount_threshold=None, stats=None, per_rule_timing=False):
+        """Evaluate every rule in one pass; returns (uint64 bitmask, weighted score in [0, 1]) per row.
+        stats get hits from the fused kernels; per_rule_timing runs rules one at a time so stats also get their time."""
+        missing_columns = [col for col in self.columns if col not in df.columns and col not in CUSTOMER_FEATURE_COLUMNS]
         if missing_columns:
             raise ValueError(f"Отсутствуют обязательные столбцы для правил: {missing_columns}")
-        
-        
-        if len(df) > 10000:
-            sample_df = df.sample(n=min(10000, len(df)), random_state=42)
-            large_amount_threshold = sample_df['amount'].quantile(0.95)
-        else:
-            large_amount_threshold = df['amount'].quantile(0.95)
-        
-        rules_flags = pd.DataFrame(index=df.index)
-        rules_flags['rule_large_amount'] = (df['amount'] > large_amount_threshold).astype(np.int8)
-        rules_flags['rule_new_destination'] = (df['oldbalanceDest'] == 0).astype(np.int8)
-        rules_flags['rule_balance_depletion'] = ((df['oldbalanceOrg'] - df['newbalanceOrig']) / (df['oldbalanceOrg'] + 1e-6) > 0.9).astype(np.int8)
-        rules_flags['rule_unusual_time'] = ((df['step'] % 24 >= 22) | (df['step'] % 24 <= 6)).astype(np.int8)
-      
-        if len(df) > 5000:
-            
-            mean_amount = df['amount'].mean()
-            rules_flags['rule_velocity_spike'] = (df['amount'] > mean_amount * 3).astype(np.int8)
-        else:
-           
-            rules_flags['rule_velocity_spike'] = (df['amount'] > df.groupby('nameOrig')['amount'].transform('mean') * 3).astype(np.int8)
-        
-        rules_flags['rule_round_amount'] = (df['amount'] % 1000 == 0).astype(np.int8)
-        
-      
-        rules_combined = rules_flags.values.mean(axis=1)
-        
-        return rules_combined, rules_flags
+
+        if large_amount_threshold is None:
+            large_amount_threshold = QuantileSketch.from_values(df['amount'].to_numpy()).quantile(0.95)
+
+        context = self._context(df, large_amount_threshold)
+        learned_score = np.zeros(len(df), dtype=np.float32)
+
+        if NUMEXPR_AVAILABLE and not per_rule_timing:
+            rules_mask = np.zeros(len(df), dtype=np.uint64)
+            rules_score = np.zeros(len(df), dtype=np.float32)
+            for group, mask_kernel, score_kernel, learned_kernel in self.kernels:
+                group_mask = numexpr.evaluate(mask_kernel, local_dict=context).astype(np.int64).view(np.uint64)
+                if score_kernel:
+                    rules_score += numexpr.evaluate(score_kernel, local_dict=context).astype(np.float32)
+                if learned_kernel:
+                    learned_score += numexpr.evaluate(learned_kernel, local_dict=context).astype(np.float32)
+                if stats is not None:
+                    stats.record_kernel(group, group_mask)
+                rules_mask |= group_mask
+            return rules_mask, self._normalize_score(rules_score, learned_score)
+
+        rules_mask = np.zeros(len(df), dtype=np.uint64)
+        rules_score = np.zeros(len(df), dtype=np.float32)
+        for i, code in enumerate(self.code):
+            start_time = time.perf_counter()
+            if NUMEXPR_AVAILABLE:
+                fired = numexpr.evaluate(self.inlined[i], local_dict=context)
+            else:
+                fired = eval(code, {'__builtins__': {}}, context)
+            fired = np.broadcast_to(np.asarray(fired, dtype=bool), len(df))
+            if stats is not None:
+                stats.record(i, time.perf_counter() - start_time, len(df), int(np.count_nonzero(fired)))
+            rules_mask |= fired.astype(np.uint64) << np.uint64(self.bits[i])
+            if self.learned[i]:
+                learned_score += fired * self.weights[i]
+            else:
+                rules_score += fired * self.weights[i]
+        return rules_mask, self._normalize_score(rules_score, learned_score)
+
+    def flags_frame(self, rules_mask, index=None):
+        """Expand a bitmask into one int8 column per rule"""
+        rules_mask = np.asarray(rules_mask, dtype=np.uint64)
+        return pd.DataFrame({
+            name: ((rules_mask >> np.uint64(bit)) & np.uint64(1)).astype(np.int8)
+            for bit, name in zip(self.bits, self.names)
+        }, index=index)
+
+    def mask_from_flags(self, rules_flags):
+        """Pack a one-column-per-rule frame back into a bitmask"""
+        rules_mask = np.zeros(len(rules_flags), dtype=np.uint64)
+        for bit, name in zip(self.bits, self.names):
+            if name in rules_flags.columns:
+                rules_mask |= (rules_flags[name].to_numpy() != 0).astype(np.uint64) << np.uint64(bit)
+        return rules_mask
+
+    def labels(self, language='ru'):
+        return [rule.get('label', {}).get(language, rule.get('label', {}).get('ru', rule['name'])) for rule in self.rules]
+
+    def explain(self, rules_mask, rows=None, language='ru', labels=None):
+        """Explanation text for the requested rows only, looked up per distinct bitmask in a memoized table"""
+        if isinstance(rules_mask, pd.DataFrame):
+            rules_mask = self.mask_from_flags(rules_mask)
+        rules_mask = np.asarray(rules_mask, dtype=np.uint64)
+        if rows is not None:
+            rules_mask = rules_mask[rows]
+
+        labels = labels or self.labels(language)
+        table = self.explanation_tables.setdefault((language, tuple(labels)), {})
+        prefix, no_flags = EXPLANATION_TEMPLATES.get(language, EXPLANATION_TEMPLATES['ru'])
+
+        masks, inverse = np.unique(rules_mask, return_inverse=True)
+        texts = np.empty(len(masks), dtype=object)
+        for j, mask in enumerate(masks.tolist()):
+            if mask not in table:
+                triggered = [label for bit, label in zip(self.bits, labels) if mask >> bit & 1]
+                table[mask] = prefix + ", ".join(triggered) if triggered else no_flags
+            texts[j] = table[mask]
+        return texts[inverse.ravel()].tolist()
+
+compiled_rules = CompiledRuleSet()
+
+def rule_engine(df, large_amount_threshold=None, stats=None, per_rule_timing=False):
+    try:
+        if df.empty:
+            raise ValueError("Пустой набор данных для применения правил.")
+
+        rules_mask, rules_combined = compiled_rules.evaluate(df, large_amount_threshold=large_amount_threshold, stats=stats,
+                                                          per_rule_timing=per_rule_timing)
+        return rules_combined, rules_mask
     except Exception as e:
         print(f"Warning: Rule engine failed: {str(e)}")
-        rules_combined = pd.Series(np.zeros(len(df)), index=df.index)
-        rules_flags = pd.DataFrame(np.zeros((len(df), 6), dtype=np.int8), index=df.index, 
-                                  columns=['rule_large_amount', 'rule_new_destination', 'rule_balance_depletion',
-                                          'rule_unusual_time', 'rule_velocity_spike', 'rule_round_amount'])
-        return rules_combined, rules_flags
-
-def get_rule_explanations(rules_flags):
-    
-    rule_names = ["очень большая сумма", "перевод на новый счет", "опустошение счета", 
-                  "необычное время", "резкий скачок активности", "круглая сумма"]
-    
-    explanations = []
-    rule_columns = ['rule_large_amount', 'rule_new_destination', 'rule_balance_depletion',
-                   'rule_unusual_time', 'rule_velocity_spike', 'rule_round_amount']
-    
-
-    for idx, row in rules_flags.iterrows():
-        triggered_indices = [i for i, col in enumerate(rule_columns) if row[col]]
-        if triggered_indices:
-            triggered_rules = [rule_names[i] for i in triggered_indices]
-            explanation = "Подозрительно из-за: " + ", ".join(triggered_rules)
-        else:
-            explanation = "Нет подозрительных признаков"
-        explanations.append(explanation)
-    
-    return explanations
\ No newline at end of file
+        return np.zeros(len(df), dtype=np.float32), np.zeros(len(df), dtype=np.uint64)
+
+def profile_rules(df, large_amount_threshold=None, rows=RULE_TIMING_ROWS):
+    """Per-rule wall time from evaluating each rule on its own over the first rows of df"""
+    stats = RuleStats(compiled_rules.names, compiled_rules.bits)
+    try:
+        if not df.empty:
+            compiled_rules.evaluate(df.iloc[:rows], large_amount_threshold=large_amount_threshold, stats=stats,
+                                    per_rule_timing=True)
+    except Exception as e:
+        print(f"Warning: Rule profiling failed: {str(e)}")
+    return stats
+
+def get_rule_explanations(rules_mask, rows=None, language='ru'):
+    return compiled_rules.explain(rules_mask, rows=rows, language=language)
@@ -6,12 +6,71 @@ from sklearn.metrics import silhouette_score
 import json
 import os
 from datetime import datetime, timedelta
+from src.feature_store import FeatureStore, build_feature_matrix
+from src.rules import compiled_rules
+
+PATTERN_COLUMNS = ['amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
+# a learned pattern that matches more rows than this multiple of its cluster is too broad to keep as a rule
+MAX_PATTERN_MATCH_FACTOR = 4
+PATTERN_RADIUS_QUANTILE = 0.9
+
+def predicate_expression(predicate):
+    """Rule-engine expression for a learned predicate: a centroid/radius ball in standardized space or a box"""
+    if predicate['type'] == 'centroid_radius':
+        distance = " + ".join(f"(({col} - ({center!r})) / {scale!r}) ** 2"
+                              for col, center, scale in zip(predicate['columns'], predicate['center'], predicate['scale']))
+        return f"{distance} <= {predicate['radius'] ** 2!r}"
+    
+    bounds = []
+    for col, (low, high) in predicate['bounds'].items():
+        if low is not None:
+            bounds.append(f"({col} >= ({low!r}))")
+        if high is not None:
+            bounds.append(f"({col} <= ({high!r}))")
+    return " & ".join(bounds)
+
+def predicate_mask(predicate, features):
+    """Rows of a PATTERN_COLUMNS matrix that satisfy a learned predicate"""
+    if predicate['type'] == 'centroid_radius':
+        distance = (((features - np.asarray(predicate['center'])) / np.asarray(predicate['scale'])) ** 2).sum(axis=1)
+        return distance <= predicate['radius'] ** 2
+    
+    matched = np.ones(len(features), dtype=bool)
+    for col, (low, high) in predicate['bounds'].items():
+        values = features[:, PATTERN_COLUMNS.index(col)]
+        if low is not None:
+            matched &= values >= low
+        if high is not None:
+            matched &= values <= high
+    return matched
+
+def predicate_covers(known, candidate):
+    """True when a known predicate already matches the candidate's centre (or whole box)"""
+    if known['type'] != candidate['type']:
+        return False
+    
+    if known['type'] == 'centroid_radius':
+        if known['columns'] != candidate['columns']:
+            return False
+        offset = (np.asarray(candidate['center']) - np.asarray(known['center'])) / np.asarray(known['scale'])
+        return float(np.sum(offset ** 2)) <= known['radius'] ** 2
+    
+    if set(known['bounds']) != set(candidate['bounds']):
+        return False
+    for col, (low, high) in candidate['bounds'].items():
+        known_low, known_high = known['bounds'][col]
+        if known_low is not None and (low is None or low < known_low):
+            return False
+        if known_high is not None and (high is None or high > known_high):
+            return False
+    return True
 
 class SelfLearningFraudDetector:
     
     def __init__(self, model_storage_path="self_learning_models"):
         self.model_storage_path = model_storage_path
         self.pattern_history = []
+        self.learned_rules = []
         self.anomaly_clusters = {}
         self.performance_metrics = {
             'detection_rates': [],
@@ -24,17 +83,27 @@ class SelfLearningFraudDetector:
             
         self.load_previous_learning()
     
-    def detect_new_patterns(self, df, fraud_scores, is_suspicious):
+    def detect_new_patterns(self, df, fraud_scores, is_suspicious, feature_store=None):
         suspicious_df = df[is_suspicious.astype(bool)].copy()
         
         if len(suspicious_df) == 0:
             return []
         
-        pattern_features = self.extract_pattern_features(suspicious_df)
+        if feature_store is not None:
+            rows = np.asarray(is_suspicious).astype(bool)
+            all_features = np.asarray(feature_store.select(PATTERN_COLUMNS), dtype=np.float64)
+        else:
+            feature_store = FeatureStore.from_frame(suspicious_df, PATTERN_COLUMNS)
+            rows = None
+            all_features = build_feature_matrix(df, PATTERN_COLUMNS).astype(np.float64)
+        pattern_features = self.extract_pattern_features(suspicious_df, feature_store=feature_store, rows=rows)
         
         if len(pattern_features) == 0:
             return []
         
+        raw_features = all_features[np.asarray(is_suspicious).astype(bool)]
+        feature_scale = raw_features.std(axis=0) + 1e-8
+        
         best_patterns = []
         
         try:
@@ -64,6 +133,14 @@ class SelfLearningFraudDetector:
                         'characteristics': self.describe_pattern(cluster_data, suspicious_df[cluster_mask]),
                         'confidence': float(count / len(suspicious_df)),
                         'cluster_center': cluster_data.mean(axis=0).tolist(),
+                        'predicate': {
+                            'type': 'centroid_radius',
+                            'columns': PATTERN_COLUMNS,
+                            'center': raw_features[cluster_mask].mean(axis=0).tolist(),
+                            'scale': feature_scale.tolist(),
+                            'radius': float(np.quantile(np.sqrt(((cluster_data - cluster_data.mean(axis=0)) ** 2).sum(axis=1)),
+                                                        PATTERN_RADIUS_QUANTILE))
+                        },
                         'detection_method': 'DBSCAN',
                         'quality_score': sil_score,
                         'cluster_size': len(cluster_data)
@@ -82,6 +159,10 @@ class SelfLearningFraudDetector:
         except Exception as e:
             print(f"Warning: Statistical pattern detection failed: {str(e)}")
         
+        for pattern in best_patterns:
+            if 'predicate' in pattern:
+                pattern['match_count'] = int(predicate_mask(pattern['predicate'], all_features).sum())
+        
         return best_patterns
     
     def detect_statistical_patterns(self, suspicious_df, suspicious_scores):
@@ -122,6 +203,7 @@ class SelfLearningFraudDetector:
                     'frequency': int(len(large_transactions)),
                     'characteristics': f"Large transaction amounts (>{large_threshold:.2f})",
                     'confidence': float(len(large_transactions) / len(amounts)),
+                    'predicate': {'type': 'box', 'bounds': {'amount': [float(large_threshold), None]}},
                     'detection_method': 'Amount Analysis',
                     'quality_score': 0.7,
                     'cluster_size': len(large_transactions)
@@ -162,23 +244,12 @@ class SelfLearningFraudDetector:
         
         return insights.strip()
 
-    def extract_pattern_features(self, df):
+    def extract_pattern_features(self, df, feature_store=None, rows=None):
         try:
-            features = []
+            if feature_store is None:
+                feature_store = FeatureStore.from_frame(df, PATTERN_COLUMNS)
             
-            required_cols = ['amount', 'oldbalanceOrg', 'newbalanceOrig', 'oldbalanceDest', 'newbalanceDest']
-            for col in required_cols:
-                if col not in df.columns:
-                    df[col] = 0
-            
-            for col in required_cols:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            
-            feature_matrix = df[required_cols].values
-            
-            feature_matrix = (feature_matrix - feature_matrix.mean(axis=0)) / (feature_matrix.std(axis=0) + 1e-8)
-            
-            return feature_matrix
+            return feature_store.standardized(PATTERN_COLUMNS, rows)
         except Exception as e:
             print(f"Warning: Could not extract pattern features: {str(e)}")
             return np.array([]).reshape(0, 5)
@@ -210,6 +281,7 @@ class SelfLearningFraudDetector:
     
     def adapt_rules_based_on_patterns(self, new_patterns):
         adapted_rules = []
+        rules_added = False
         
         for pattern in new_patterns:
             rule = {
@@ -221,6 +293,7 @@ class SelfLearningFraudDetector:
             }
             
             adapted_rules.append(rule)
+            rules_added = self.learn_rule(rule, pattern) or rules_added
             
             self.performance_metrics['adaptation_events'].append({
                 'timestamp': datetime.now().isoformat(),
@@ -228,13 +301,68 @@ class SelfLearningFraudDetector:
                 'rule_id': rule['rule_id']
             })
         
+        if rules_added:
+            self.save_learned_rules()
+        
         return adapted_rules
     
     def generate_adaptive_conditions(self, pattern):
-        return {
+        conditions = {
             'min_confidence': pattern['confidence'],
             'pattern_match_required': True
         }
+        if 'predicate' in pattern:
+            conditions['predicate'] = pattern['predicate']
+        return conditions
+    
+    def learn_rule(self, rule, pattern):
+        """Turn an adaptive rule with a predicate into a rule-engine definition, unless a learned rule already covers it"""
+        predicate = rule['conditions'].get('predicate')
+        if predicate is None or pattern.get('match_count', 0) > MAX_PATTERN_MATCH_FACTOR * pattern['frequency']:
+            return False
+        
+        name = f"learned_{pattern['pattern_id']}"
+        for known in self.learned_rules:
+            if known['name'] == name or predicate_covers(known['predicate'], predicate):
+                return False
+        
+        # the slot count shrinks as custom rules take mask bits; rules left outside it are dropped by the engine too
+        slot_count = compiled_rules.learned_slot_count
+        if slot_count == 0:
+            return False
+        self.learned_rules = [known for known in self.learned_rules if known['slot'] < slot_count]
+        used_slots = {known['slot'] for known in self.learned_rules}
+        free_slots = [slot for slot in range(slot_count) if slot not in used_slots]
+        if free_slots:
+            slot = free_slots[0]
+        else:
+            slot = self.learned_rules.pop(0)['slot']
+        
+        self.learned_rules.append({
+            'name': name,
+            'slot': slot,
+            'expression': predicate_expression(predicate),
+            'weight': float(rule['confidence']),
+            'label': {'ru': f"выученный паттерн: {pattern['characteristics']}",
+                      'en': f"learned pattern: {pattern['characteristics']}"},
+            'predicate': predicate
+        })
+        return True
+    
+    def save_learned_rules(self):
+        """Publish learned rules to the rule engine so the next evaluation matches them without re-clustering"""
+        path = compiled_rules.learned_rules_path
+        try:
+            rules_dir = os.path.dirname(path)
+            if rules_dir and not os.path.exists(rules_dir):
+                os.makedirs(rules_dir)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.learned_rules, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+            compiled_rules.reload()
+        except Exception as e:
+            print(f"Warning: Could not save learned rules: {str(e)}")
     
     def update_performance_metrics(self, df, is_suspicious, ground_truth=None):
         metrics = {}
@@ -281,6 +409,7 @@ class SelfLearningFraudDetector:
                     'false_positive_rates': [],
                     'adaptation_events': []
                 })
+            self.learned_rules = compiled_rules.load_learned_rules()
         except Exception as e:
             print(f"Warning: Could not load previous learning state: {str(e)}")
     
@@ -295,7 +424,7 @@ class SelfLearningFraudDetector:
 
 self_learning_detector = SelfLearningFraudDetector()
 
-def integrate_self_learning(df, fraud_scores, is_suspicious):
+def integrate_self_learning(df, fraud_scores, is_suspicious, feature_store=None):
     try:
         if df.empty or len(fraud_scores) == 0 or len(is_suspicious) == 0:
             print("Self-learning: Empty data provided, skipping learning phase")
@@ -308,7 +437,8 @@ def integrate_self_learning(df, fraud_scores, is_suspicious):
         if len(df) != len(fraud_scores) or len(df) != len(is_suspicious):
             raise ValueError("Несоответствие размеров данных для самообучения")
         
-        new_patterns = self_learning_detector.detect_new_patterns(df, fraud_scores, is_suspicious)
+        new_patterns = self_learning_detector.detect_new_patterns(df, fraud_scores, is_suspicious,
+                                                                  feature_store=feature_store)
         
         if new_patterns:
             adapted_rules = self_learning_detector.adapt_rules_based_on_patterns(new_patterns)
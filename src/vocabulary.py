@@ -0,0 +1,73 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import threading
+
+UNSEEN_CODE = -1
+
+DEFAULT_VOCABULARIES = {
+    'type': ['CASH_IN', 'CASH_OUT', 'DEBIT', 'PAYMENT', 'TRANSFER']
+}
+
+class CategoryVocabulary:
+
+    def __init__(self, storage_path="models/category_vocabulary.json"):
+        self.storage_path = storage_path
+        self.vocabularies = {name: list(values) for name, values in DEFAULT_VOCABULARIES.items()}
+        self.vocabulary_lock = threading.Lock()
+
+        storage_dir = os.path.dirname(storage_path)
+        if storage_dir and not os.path.exists(storage_dir):
+            os.makedirs(storage_dir)
+
+        self.load_vocabulary()
+
+    def load_vocabulary(self):
+        try:
+            if os.path.exists(self.storage_path):
+                with open(self.storage_path, 'r', encoding='utf-8') as f:
+                    self._merge(json.load(f))
+        except Exception as e:
+            print(f"Warning: Could not load category vocabulary: {str(e)}")
+
+    def save_vocabulary(self):
+        try:
+            temp_path = f"{self.storage_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.vocabularies, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.storage_path)
+        except Exception as e:
+            print(f"Warning: Could not save category vocabulary: {str(e)}")
+
+    def _merge(self, vocabularies):
+        """Append values known elsewhere without renumbering the ones already held"""
+        for name, values in vocabularies.items():
+            known = self.vocabularies.setdefault(name, [])
+            known_set = set(known)
+            known.extend(value for value in values if value not in known_set)
+
+    def categories(self, name):
+        return pd.Index(self.vocabularies.get(name, []), dtype=object)
+
+    def encode(self, name, values, extend=True):
+        """Stable integer codes for a column; unseen values get UNSEEN_CODE unless the vocabulary is extended"""
+        values = pd.Series(values)
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(str).astype('category')
+        observed = values.cat.categories.astype(str)
+
+        if extend:
+            new_values = observed.difference(self.categories(name), sort=False)
+            if len(new_values) > 0:
+                with self.vocabulary_lock:
+                    self.load_vocabulary()
+                    self._merge({name: sorted(new_values)})
+                    self.save_vocabulary()
+
+        category_codes = self.categories(name).get_indexer(observed)
+        row_codes = values.cat.codes.to_numpy()
+        codes = np.where(row_codes >= 0, category_codes[row_codes], UNSEEN_CODE)
+        return codes.astype(np.int32)
+
+category_vocabulary = CategoryVocabulary()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+from src.advanced_models import (FastAutoEncoder, train_autoencoder_fast, export_autoencoder, load_exported_autoencoder,
+                                 exported_anomaly_scores, autoencoder_anomaly_scores_fast, check_export_parity)
+
+@pytest.fixture(scope='module')
+def features():
+    rng = np.random.default_rng(0)
+    X = rng.lognormal(mean=8, sigma=2, size=(600, 6)).astype(np.float32)
+    X[:10] *= 50
+    return X
+
+@pytest.fixture(scope='module')
+def model(features):
+    torch.manual_seed(0)
+    return train_autoencoder_fast(features, epochs=2, time_budget_s=None)
+
+def eager_scores(model, X):
+    with torch.no_grad():
+        return model.reconstruction_error(torch.from_numpy(X)).numpy()
+
+def test_trained_model_is_fast_autoencoder(model):
+    assert isinstance(model, FastAutoEncoder)
+    assert not model.training
+
+def test_exported_graph_matches_eager_model(model, features):
+    parity = check_export_parity(model, export_autoencoder(model), features)
+    assert parity['rows'] == len(features)
+    assert parity['max_abs_error'] <= 1e-5
+    assert parity['rank_correlation'] > 0.9999
+
+def test_batched_scoring_matches_eager_model(model, features):
+    scores = exported_anomaly_scores(export_autoencoder(model), features, batch_rows=128)
+    np.testing.assert_allclose(scores, eager_scores(model, features), rtol=1e-5, atol=1e-6)
+
+def test_saved_graph_scores_like_eager_model(model, features, tmp_path):
+    path = str(tmp_path / 'autoencoder.pt')
+    export_autoencoder(model, path=path)
+    scores = exported_anomaly_scores(load_exported_autoencoder(path), features)
+    np.testing.assert_allclose(scores, eager_scores(model, features), rtol=1e-5, atol=1e-6)
+
+def test_memmapped_matrix_scores_like_eager_model(model, features, tmp_path):
+    path = tmp_path / 'features.npy'
+    np.save(path, features)
+    matrix = np.load(path, mmap_mode='r')
+    np.testing.assert_allclose(autoencoder_anomaly_scores_fast(model, matrix), eager_scores(model, features),
+                               rtol=1e-5, atol=1e-6)